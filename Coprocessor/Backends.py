@@ -0,0 +1,588 @@
+from abc import ABC, abstractmethod
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import cv2
+import numpy as np
+import constants
+from constants import (APRIL_TAG_WIDTH, CAMERA_HORIZONTAL_RESOLUTION_PIXELS, CAMERA_VERTICAL_RESOLUTION_PIXELS,
+                       CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS, CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS)
+
+"""
+This file contains the capture backends the FrameGrabber reads frames from. A backend has the same methods as
+cv2.VideoCapture (grab, retrieve, read, get, set, isOpened and release), so the grabber doesn't care where the frames
+come from and a plain cv2.VideoCapture still works as one. There are three backends:
+
+* OpenCVBackend reads from a real camera through OpenCV, using V4L2 on Linux.
+* ReplayBackend plays back a video file, a directory of images or a recording from .saves.
+* SyntheticBackend renders AprilTags and colored pieces at scripted poses, so the whole server can be run and
+  benchmarked deterministically without a camera.
+
+Use open_backend to pick the right one for a camera name.
+"""
+
+# Pacing of replayed recordings and synthetic scenes
+REPLAY_REALTIME = "realtime"
+REPLAY_FIXED = "fixed"
+REPLAY_FAST = "fast"
+REPLAY_PACINGS = (REPLAY_REALTIME, REPLAY_FIXED, REPLAY_FAST)
+REPLAY_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Camera names starting with this open a synthetic scene. "synthetic" plays the default scene and
+# "synthetic:path/to/scene.json" plays a scripted one.
+SYNTHETIC_PREFIX = "synthetic"
+
+
+def is_replay_source(name):
+    """
+    :param name: The name a camera was opened with.
+    :return: True if name is a path to a recording rather than a camera index or device.
+    """
+    return isinstance(name, str) and not name.startswith("/dev/") and os.path.exists(name)
+
+
+def is_synthetic_source(name):
+    """
+    :param name: The name a camera was opened with.
+    :return: True if name asks for a synthetic scene.
+    """
+    return isinstance(name, str) and (name == SYNTHETIC_PREFIX or name.startswith(SYNTHETIC_PREFIX + ":"))
+
+
+def open_backend(name):
+    """
+    Open the capture backend for a camera name.
+    :param name: Camera index or device path, path to a video file, image or directory of images, or "synthetic" /
+    "synthetic:<scene.json>".
+    :return: CaptureBackend
+    """
+    if is_synthetic_source(name):
+        return SyntheticBackend(name[len(SYNTHETIC_PREFIX) + 1:] or None)
+    if is_replay_source(name):
+        return ReplayBackend(name)
+    return OpenCVBackend(name)
+
+
+# Resolutions tried when a camera's modes can't be listed with v4l2-ctl
+COMMON_RESOLUTIONS = ((320, 240), (424, 240), (640, 360), (640, 480), (800, 600), (848, 480), (960, 540), (1024, 768),
+                      (1280, 720), (1280, 800), (1280, 960), (1920, 1080))
+
+
+def fourcc_to_string(fourcc):
+    """
+    :param fourcc: Integer FOURCC code as returned by cv2.VideoCapture.get(cv2.CAP_PROP_FOURCC)
+    :return: The four character string, e.g. "MJPG"
+    """
+    fourcc = int(fourcc)
+    return "".join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4))
+
+
+def parse_v4l2_formats(output):
+    """
+    Parse the output of v4l2-ctl --list-formats-ext into a list of modes. Only discrete sizes and intervals are listed,
+    which is what USB cameras report.
+    :param output: str
+    :return: List of {"format": str, "width": int, "height": int, "fps": float}
+    """
+    modes = []
+    pixel_format = size = None
+    for line in output.splitlines():
+        match = re.search(r"\[\d+\]: '(\w+)'", line)
+        if match:
+            pixel_format, size = match.group(1), None
+            continue
+        match = re.search(r"Size: Discrete (\d+)x(\d+)", line)
+        if match:
+            size = (int(match.group(1)), int(match.group(2)))
+            continue
+        match = re.search(r"\(([\d.]+) fps\)", line)
+        if match and pixel_format is not None and size is not None:
+            modes.append({"format": pixel_format, "width": size[0], "height": size[1], "fps": float(match.group(1))})
+    return modes
+
+
+def pick_camera_mode(modes, width, height, formats):
+    """
+    Pick the cheapest mode that delivers at least the given resolution: the fewest pixels, then the closest aspect
+    ratio, then the most preferred format, then the highest frame rate. If no mode is large enough the largest one is
+    used.
+    :param modes: List of modes as returned by CaptureBackend.list_modes
+    :param width: Wanted width in pixels
+    :param height: Wanted height in pixels
+    :param formats: FOURCC strings in order of preference. Modes in other formats are only used if there is no choice.
+    :return: The chosen mode, or None if modes is empty.
+    """
+    candidates = [mode for mode in modes if mode["format"] in formats] or list(modes)
+    if not candidates:
+        return None
+    large_enough = [mode for mode in candidates if mode["width"] >= width and mode["height"] >= height]
+    if not large_enough:
+        return max(candidates, key=lambda mode: (mode["width"] * mode["height"], mode["fps"]))
+
+    aspect = width / height
+    return min(large_enough, key=lambda mode: (mode["width"] * mode["height"],
+                                               abs(mode["width"] / mode["height"] - aspect),
+                                               formats.index(mode["format"]) if mode["format"] in formats
+                                               else len(formats),
+                                               -mode["fps"]))
+
+
+def record_banner_height(height):
+    """
+    Recordings in .saves have a banner added above every frame (see draw_image_to_record). Work out how tall it is.
+    :param height: Height of the recorded frame.
+    :return: Height of the banner in pixels.
+    """
+    original = round(height / 1.1)
+    return height - original if original + int(original * 0.1) == height else 0
+
+
+class CaptureBackend(ABC):
+    """
+    Base class for capture backends. Subclasses must implement grab and retrieve, which is checked when they are
+    created, and whichever of the others they need. A backend that has no more frames to give (such as a recording that
+    doesn't loop) sets finished to True, so the grabber doesn't try to reconnect it.
+    """
+    finished = False
+
+    def wait(self, timeout):
+        """
+        Wait until grab can return the next frame without blocking, or until the timeout expires. The grabber calls this
+        without holding its camera lock, so get and set don't wait for the next frame. Backends that can't tell block in
+        grab instead.
+        :param timeout: Maximum number of seconds to wait.
+        :return: False if the timeout expired before the next frame was due, so grab should not be called yet.
+        """
+        return True
+
+    @abstractmethod
+    def grab(self):
+        """
+        Read the next frame without decoding it.
+        :return: True if a frame was read.
+        """
+
+    @abstractmethod
+    def retrieve(self):
+        """
+        :return: (bool, ndarray) The frame read by the last grab, like cv2.VideoCapture.retrieve.
+        """
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        return 0
+
+    def isOpened(self):
+        return not self.finished
+
+    def release(self):
+        self.finished = True
+
+    def list_modes(self):
+        """
+        :return: The resolution, frame rate and format combinations the source supports, as dictionaries with "format",
+        "width", "height" and "fps". Empty if the source has no fixed modes.
+        """
+        return []
+
+
+class OpenCVBackend(CaptureBackend):
+    """
+    Reads from a camera through cv2.VideoCapture. Cameras are opened with V4L2 on Linux, anything else (such as a stream
+    URL) is left for OpenCV to figure out.
+    """
+    def __init__(self, name):
+        self.name = name
+        is_device = isinstance(name, int) or (isinstance(name, str) and name.startswith("/dev/"))
+        api = cv2.CAP_V4L2 if is_device and sys.platform.startswith("linux") else cv2.CAP_ANY
+        self.capture = cv2.VideoCapture(name, api)
+        # Only V4L2 captures can be waited on without grabbing
+        self.waitable = api == cv2.CAP_V4L2 and hasattr(cv2.VideoCapture, "waitAny")
+
+    def wait(self, timeout):
+        # A camera that sends nothing still has to be grabbed from, so the grabber notices and reconnects it
+        if self.waitable:
+            try:
+                cv2.VideoCapture.waitAny([self.capture], int(timeout * 1e9))
+            except cv2.error:
+                self.waitable = False
+        return True
+
+    def grab(self):
+        return self.capture.grab()
+
+    def retrieve(self):
+        return self.capture.retrieve()
+
+    def read(self):
+        return self.capture.read()
+
+    def set(self, prop, value):
+        return self.capture.set(prop, value)
+
+    def get(self, prop):
+        return self.capture.get(prop)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.capture.release()
+
+    def list_modes(self):
+        """
+        List the camera's modes with v4l2-ctl. If that isn't available, try common resolutions in MJPG and YUYV and see
+        which ones the camera accepts. This can take a few seconds, so the result should be cached.
+        """
+        device = f"/dev/video{self.name}" if isinstance(self.name, int) else self.name
+        if isinstance(device, str) and device.startswith("/dev/"):
+            try:
+                output = subprocess.run(["v4l2-ctl", "--list-formats-ext", "-d", device], capture_output=True,
+                                        text=True, timeout=5).stdout
+                modes = parse_v4l2_formats(output)
+                if modes:
+                    return modes
+            except (OSError, subprocess.SubprocessError):
+                pass
+
+        modes = []
+        original = [(prop, self.capture.get(prop)) for prop in (cv2.CAP_PROP_FOURCC, cv2.CAP_PROP_FRAME_WIDTH,
+                                                                cv2.CAP_PROP_FRAME_HEIGHT)]
+        for pixel_format in ("MJPG", "YUYV"):
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*pixel_format))
+            if fourcc_to_string(self.capture.get(cv2.CAP_PROP_FOURCC)) != pixel_format:
+                continue
+            for width, height in COMMON_RESOLUTIONS:
+                self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+                if (self.capture.get(cv2.CAP_PROP_FRAME_WIDTH) == width
+                        and self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT) == height):
+                    modes.append({"format": pixel_format, "width": width, "height": height,
+                                  "fps": self.capture.get(cv2.CAP_PROP_FPS)})
+        for prop, value in original:
+            self.capture.set(prop, value)
+        return modes
+
+
+class PacedBackend(CaptureBackend):
+    """
+    Base class for backends that produce frames on their own schedule instead of a camera's. With "realtime" pacing
+    frames come at the source's own frame rate, with "fixed" pacing at the given fps, and with "fast" pacing every
+    frame is returned as soon as it is asked for. Properties that are set are only remembered, so get returns them.
+    """
+    def __init__(self, pacing=None, fps=None, loop=None):
+        self.pacing = constants.REPLAY_PACING if pacing is None else pacing
+        self.fps = constants.REPLAY_FPS if fps is None else fps
+        self.loop = constants.REPLAY_LOOP if loop is None else loop
+        if self.pacing not in REPLAY_PACINGS:
+            raise ValueError(f'Error: Unknown replay pacing "{self.pacing}". Use one of {", ".join(REPLAY_PACINGS)}.')
+        self.properties = {}
+        self.frames_played = 0
+        self.start_time = None
+        self.shape = None
+        self.finished = False
+
+    def wait(self, timeout):
+        """
+        Sleep until the next frame is due. The schedule runs on across loops, so the frame rate stays steady.
+        """
+        if self.pacing == REPLAY_FAST or self.fps <= 0:
+            return True
+        now = time.monotonic()
+        if self.start_time is None:
+            self.start_time = now
+        due = self.start_time + self.frames_played / self.fps
+        if due - now > timeout:
+            time.sleep(timeout)
+            return False
+        if due > now:
+            time.sleep(due - now)
+        return True
+
+    def set(self, prop, value):
+        self.properties[prop] = value
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return 0 if self.pacing == REPLAY_FAST else self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_played
+        if self.shape is not None and prop in (cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FRAME_WIDTH):
+            return self.shape[0] if prop == cv2.CAP_PROP_FRAME_HEIGHT else self.shape[1]
+        return self.properties.get(prop, -1)
+
+
+class ReplayBackend(PacedBackend):
+    """
+    Plays back a recording as if it were a camera. The source can be a video file, a single image or a directory of
+    images, which are played in order of their names. Recordings from .saves have their banner cut off so the frames
+    look like the ones the camera delivered. Videos played with "realtime" pacing use their own frame rate.
+
+    When the end is reached the recording either starts over or stops delivering frames, after which finished is True.
+    """
+    def __init__(self, path, pacing=None, fps=None, loop=None):
+        super().__init__(pacing, fps, loop)
+        self.path = path
+        self.video = None
+        self.files = []
+        if os.path.isdir(path):
+            self.files = sorted(os.path.join(path, file) for file in os.listdir(path)
+                                if file.lower().endswith(REPLAY_IMAGE_EXTENSIONS))
+        elif path.lower().endswith(REPLAY_IMAGE_EXTENSIONS):
+            self.files = [path]
+        else:
+            self.video = cv2.VideoCapture(path)
+            if self.pacing == REPLAY_REALTIME and self.video.get(cv2.CAP_PROP_FPS) > 0:
+                self.fps = self.video.get(cv2.CAP_PROP_FPS)
+        self.strip_banner = ".saves" in os.path.normpath(os.path.abspath(path)).split(os.sep)
+        self.index = -1  # Position in files of the grabbed frame
+
+    def isOpened(self):
+        if self.finished:
+            return False
+        return self.video.isOpened() if self.video is not None else len(self.files) > 0
+
+    def _advance(self):
+        if self.video is not None:
+            return self.video.grab()
+        self.index += 1
+        return self.index < len(self.files)
+
+    def _rewind(self):
+        if self.video is not None:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        else:
+            self.index = -1
+
+    def grab(self):
+        if not self.isOpened():
+            return False
+        grabbed = self._advance()
+        if not grabbed and self.loop:
+            self._rewind()
+            grabbed = self._advance()
+        if not grabbed:
+            self.finished = True
+            return False
+        self.frames_played += 1
+        return True
+
+    def retrieve(self):
+        if self.video is not None:
+            ret, image = self.video.retrieve()
+        else:
+            path = self.files[self.index]
+            if not self.properties.get(cv2.CAP_PROP_CONVERT_RGB, 1) and not self.strip_banner \
+                    and path.lower().endswith((".jpg", ".jpeg")):
+                # Like a camera in mjpeg mode, hand the compressed image over without decoding it
+                image = np.fromfile(path, dtype=np.uint8)
+                return True, image
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            ret = image is not None
+        if not ret:
+            return False, None
+        if self.strip_banner:
+            image = image[record_banner_height(image.shape[0]):]
+        self.shape = image.shape
+        return True, image
+
+    def release(self):
+        if self.video is not None:
+            self.video.release()
+        self.finished = True
+
+
+# The scene played by SyntheticBackend when no script is given: two tags swinging in front of the camera and an orange
+# piece rolling across the floor. See SyntheticBackend for the format.
+DEFAULT_SYNTHETIC_SCENE = {
+    "fps": 30,
+    "keyframes": [
+        {"time": 0,
+         "tags": [{"id": 1, "x": -0.4, "y": 0.0, "z": 1.5, "yaw": -0.5},
+                  {"id": 2, "x": 0.5, "y": -0.1, "z": 2.5, "yaw": 0.3, "roll": 0.2}],
+         "pieces": [{"color": [255, 128, 0], "x": -0.8, "y": 0.4, "z": 1.2, "radius": 0.09}]},
+        {"time": 2,
+         "tags": [{"id": 1, "x": 0.2, "y": 0.1, "z": 1.0, "yaw": 0.5},
+                  {"id": 2, "x": 0.3, "y": -0.2, "z": 3.5, "yaw": -0.3, "pitch": 0.3}],
+         "pieces": [{"color": [255, 128, 0], "x": 0.8, "y": 0.4, "z": 1.8, "radius": 0.09}]},
+        {"time": 4,
+         "tags": [{"id": 1, "x": -0.4, "y": 0.0, "z": 1.5, "yaw": -0.5},
+                  {"id": 2, "x": 0.5, "y": -0.1, "z": 2.5, "yaw": 0.3, "roll": 0.2}],
+         "pieces": [{"color": [255, 128, 0], "x": -0.8, "y": 0.4, "z": 1.2, "radius": 0.09}]}
+    ]
+}
+
+
+def _interpolate(start, end, amount):
+    """
+    Interpolate every number in two object descriptions. Keys only in start are held.
+    """
+    return {key: (value + (end[key] - value) * amount if key in end and isinstance(value, (int, float))
+                  and key != "id" else value)
+            for key, value in start.items()}
+
+
+def _rotation(yaw, pitch, roll):
+    """
+    Rotation matrix for a yaw about the camera's y axis, a pitch about its x axis and a roll about its z axis.
+    """
+    cy, sy, cp, sp, cr, sr = np.cos(yaw), np.sin(yaw), np.cos(pitch), np.sin(pitch), np.cos(roll), np.sin(roll)
+    r_yaw = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    r_pitch = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    r_roll = np.array([[cr, -sr, 0], [sr, cr, 0], [0, 0, 1]])
+    return r_yaw @ r_pitch @ r_roll
+
+
+class SyntheticBackend(PacedBackend):
+    """
+    Renders a scripted scene of AprilTags (family tag36h11) and colored pieces, so throughput and latency can be
+    measured without a camera, with the same frames on every run. The scene is given as JSON:
+
+    {"fps": 30, "width": 640, "height": 480, "background": 110,
+     "keyframes": [{"time": 0, "tags": [{"id": 1, "x": 0, "y": 0, "z": 2, "yaw": 0, "pitch": 0, "roll": 0}],
+                    "pieces": [{"color": [255, 128, 0], "x": 0, "y": 0.4, "z": 1.5, "radius": 0.09}]}, ...]}
+
+    Positions are in meters in the camera's frame (x right, y down, z forward) and angles are in radians. Tags are
+    APRIL_TAG_WIDTH wide, colors are RGB. Objects are matched between keyframes by their position in the list and moved
+    linearly from one keyframe to the next. Time comes from the frame number, not the clock, so the scene is the same no
+    matter how fast it is played. After the last keyframe the scene starts over, or finishes if looping is off.
+
+    Like a camera, the backend sends JPEG when asked for MJPG without RGB conversion, and YUYV when asked for YUYV, so
+    every capture mode can be exercised.
+    """
+    def __init__(self, script=None, pacing=None, fps=None, loop=None):
+        super().__init__(pacing, fps, loop)
+        if script is None:
+            self.scene = DEFAULT_SYNTHETIC_SCENE
+        else:
+            with open(script, 'r') as f:
+                self.scene = json.load(f)
+        self.keyframes = sorted(self.scene["keyframes"], key=lambda keyframe: keyframe["time"])
+        self.scene_fps = self.scene.get("fps", 30)
+        if self.pacing == REPLAY_REALTIME:
+            self.fps = self.scene_fps
+        self.duration = self.keyframes[-1]["time"]
+        self.properties = {cv2.CAP_PROP_FRAME_WIDTH: self.scene.get("width", CAMERA_HORIZONTAL_RESOLUTION_PIXELS),
+                           cv2.CAP_PROP_FRAME_HEIGHT: self.scene.get("height", CAMERA_VERTICAL_RESOLUTION_PIXELS),
+                           cv2.CAP_PROP_CONVERT_RGB: 1}
+        self.markers = {}
+
+    def _state_at(self, scene_time):
+        """
+        :return: (tags, pieces) at the given time in the scene.
+        """
+        previous = self.keyframes[0]
+        for keyframe in self.keyframes[1:]:
+            if keyframe["time"] > scene_time:
+                break
+            previous = keyframe
+        else:
+            return previous.get("tags", []), previous.get("pieces", [])
+
+        amount = (scene_time - previous["time"]) / (keyframe["time"] - previous["time"])
+        state = []
+        for kind in ("tags", "pieces"):
+            starts, ends = previous.get(kind, []), keyframe.get(kind, [])
+            state.append([_interpolate(start, end, amount) for start, end in zip(starts, ends)] + starts[len(ends):])
+        return tuple(state)
+
+    def _marker(self, tag_id):
+        """
+        The image of a tag, with a white border one cell wide around the black one. Cached per id.
+        :return: (image, size of the black square in pixels, border in pixels)
+        """
+        if tag_id not in self.markers:
+            dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+            cell = 16
+            if hasattr(cv2.aruco, "generateImageMarker"):
+                marker = cv2.aruco.generateImageMarker(dictionary, tag_id, 8 * cell)
+            else:
+                marker = cv2.aruco.drawMarker(dictionary, tag_id, 8 * cell)
+            self.markers[tag_id] = (cv2.copyMakeBorder(marker, cell, cell, cell, cell, cv2.BORDER_CONSTANT,
+                                                       value=255), 8 * cell, cell)
+        return self.markers[tag_id]
+
+    def render(self, scene_time):
+        """
+        Draw the scene as it is at the given time.
+        :param scene_time: Seconds since the start of the scene.
+        :return: BGR ndarray
+        """
+        width = int(self.properties[cv2.CAP_PROP_FRAME_WIDTH])
+        height = int(self.properties[cv2.CAP_PROP_FRAME_HEIGHT])
+        fx = (width / 2) / np.tan(CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS / 2)
+        fy = (height / 2) / np.tan(CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS / 2)
+        camera_matrix = np.array([[fx, 0, width / 2], [0, fy, height / 2], [0, 0, 1]])
+        image = np.full((height, width, 3), self.scene.get("background", 110), dtype=np.uint8)
+
+        tags, pieces = self._state_at(scene_time)
+        # Draw from back to front so nearer objects cover farther ones
+        objects = [("tag", tag) for tag in tags] + [("piece", piece) for piece in pieces]
+        for kind, item in sorted(objects, key=lambda pair: -pair[1]["z"]):
+            if kind == "piece":
+                if item["z"] <= 0:
+                    continue
+                center = camera_matrix @ np.array([item["x"], item["y"], item["z"]])
+                radius = int(round(fx * item["radius"] / item["z"]))
+                cv2.circle(image, (int(round(center[0] / center[2])), int(round(center[1] / center[2]))), radius,
+                           tuple(int(c) for c in item["color"][::-1]), -1, cv2.LINE_AA)
+                continue
+
+            marker, size, border = self._marker(int(item["id"]))
+            half = APRIL_TAG_WIDTH / 2
+            corners = np.array([[-half, -half, 0], [half, -half, 0], [half, half, 0], [-half, half, 0]])
+            rotation = _rotation(item.get("yaw", 0), item.get("pitch", 0), item.get("roll", 0))
+            points = corners @ rotation.T + np.array([item["x"], item["y"], item["z"]])
+            if np.any(points[:, 2] <= 0.01):
+                continue
+            projected = points @ camera_matrix.T
+            projected = (projected[:, :2] / projected[:, 2:]).astype(np.float32)
+            source = np.array([[border, border], [border + size, border], [border + size, border + size],
+                               [border, border + size]], dtype=np.float32)
+            homography = cv2.getPerspectiveTransform(source, projected)
+            warped = cv2.warpPerspective(marker, homography, (width, height), flags=cv2.INTER_LINEAR,
+                                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            mask = cv2.warpPerspective(np.full(marker.shape, 255, dtype=np.uint8), homography, (width, height),
+                                       flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            image[mask > 0] = warped[mask > 0, None]
+        return image
+
+    def grab(self):
+        if self.finished:
+            return False
+        if not self.loop and self.frames_played / self.scene_fps > self.duration:
+            self.finished = True
+            return False
+        self.frames_played += 1
+        return True
+
+    def retrieve(self):
+        scene_time = (self.frames_played - 1) / self.scene_fps
+        if self.loop and self.duration > 0:
+            scene_time %= self.duration
+        image = self.render(scene_time)
+        self.shape = image.shape
+
+        if self.properties.get(cv2.CAP_PROP_CONVERT_RGB, 1):
+            return True, image
+        if self.properties.get(cv2.CAP_PROP_FOURCC) == cv2.VideoWriter_fourcc(*'YUYV'):
+            # Pack the image the way a YUYV camera would: luma for every pixel, chroma shared by pairs of pixels
+            yuv = cv2.cvtColor(image, cv2.COLOR_BGR2YUV)
+            packed = np.empty(image.shape[:2] + (2,), dtype=np.uint8)
+            packed[:, :, 0] = yuv[:, :, 0]
+            packed[:, 0::2, 1] = yuv[:, 0::2, 1]
+            packed[:, 1::2, 1] = yuv[:, 0::2, 2]
+            return True, packed
+        _, encoded = cv2.imencode('.jpg', image)
+        return True, encoded.reshape(-1)
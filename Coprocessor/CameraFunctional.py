@@ -2,16 +2,29 @@ import base64
 from fileinput import filename
 import os
 import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 from Locater import Locater
 import json
 import base64
-from apriltag import Detector, DetectorOptions
+from apriltag import Detector, DetectorOptions, TagFilter
+from Capture import (FrameGrabber, CAMERA_OK, CAPTURE_MODES, CAPTURE_FORMATS, COLOR_BGR, COLOR_GRAY,
+                     convert_color)
+from Backends import pick_camera_mode
+from Pipeline import Pipeline
+from MotionFilter import TagMotionFilter
+from Preprocess import get_preprocessor, convert_preprocessing_mode, PreprocessSelector, AUTO_MODE
+from TagTracking import TagTracker, detect_scaled, detect_pyramid, horizon_band
+import TagPose
 from constants import (APRIL_TAG_WIDTH, APRIL_TAG_HEIGHT,
                        HORIZONTAL_FOCAL_LENGTH, VERTICAL_FOCAL_LENGTH, CAMERA_HORIZONTAL_RESOLUTION_PIXELS,
                        CAMERA_VERTICAL_RESOLUTION_PIXELS, DOWNSCALE_FACTOR, CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS,
-                       CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS, CAMERA_HEIGHT, RECORD, cv2_props_dict)
+                       CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS, CAMERA_HEIGHT, RECORD, CAPTURE_MODE, PYRAMID_LEVELS,
+                       PYRAMID_MIN_TAG_PIXELS, DETECTOR_OPTIONS, TAG_FILTER, WORKER_THREADS,
+                       cv2_props_dict)
 
 """
 This file contains the FunctionalObject class which is used to create an object that can be used to interact with the
@@ -76,11 +89,6 @@ def draw_image_to_record(image, text=None, color=None):
 # are used in the FunctionalObject class to convert the values received from the client to the correct data type before
 # using them in the functions of the class. They are simply used to provide intuitive error messages.
 
-def get_with_type(d, key, default=None, expected_type=int):
-    # Basically dictionary.get but enforces types
-    value = d.get(key, default)
-    return value if isinstance(value, expected_type) else default
-
 def json_we(value, name):
     try:
         return json.loads(value)
@@ -112,55 +120,107 @@ def bool_we(value, name):
     raise ValueError(f'Error: Could not convert parameter "{name}" with value "{value}" to a boolean.')
 
 
-def l3_preprocess(image, **kwargs):
-    # TODO: make stuff scale to image size
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    clahe = cv2.createCLAHE(clipLimit=get_with_type(kwargs, "clahe_clip_limit", 3), 
-        tileGridSize=(get_with_type(kwargs, "clahe_tile_size", 8), get_with_type(kwargs, "clahe_tile_size", 8)))
-    enhanced = clahe.apply(gray_image)
+def frame_result_message(data, frame, processed_time):
+    """
+    Serialize the result of processing a frame, stamped with the frame's timing information. The send time is left for
+    CameraFunctionalObject.send_frame_message to add.
+    :param data: The response dictionary.
+    :param frame: The Frame the response was computed from.
+    :param processed_time: The time at which processing of the frame finished.
+    :return: The JSON message.
+    """
+    data["sequence"] = frame.sequence
+    data["capture_time"] = frame.timestamp
+    data["processed_time"] = processed_time
+    return json.dumps(data)
 
-    edges = cv2.Canny(gray_image, 
-        get_with_type(kwargs, "canny_threshold_1", 50), get_with_type(kwargs, "canny_threshold_1", 150))
-    kernel = np.ones([get_with_type(kwargs, "edge_refinement_kernel_size", 3), 
-        get_with_type(kwargs, "edge_refinement_kernel_size", 3)], np.uint8)
-    dilated = cv2.dilate(edges, kernel, 1)
 
-    closed = cv2.morphologyEx(dilated, cv2.MORPH_CLOSE, kernel, iterations=1)
+async def stop_pipeline(pipeline):
+    """
+    Stop a Pipeline from a coroutine without blocking the event loop while its threads finish.
+    """
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.stop)
 
-    thresh = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 35,3)
 
-    highlighted = cv2.bitwise_and(thresh, thresh, closed)
-    return highlighted
+def convert_detector_options(values, options):
+    """
+    Convert AprilTag detector options received from the client. Like in set_camera_params, empty values are skipped.
+    :param values: Dictionary of option names to values. Names not in DETECTOR_OPTIONS are ignored.
+    :param options: The current options.
+    :return: A copy of options updated with values.
+    """
+    options = dict(options)
+    for key, value in values.items():
+        if key not in DETECTOR_OPTIONS or value == '':
+            continue
+        if key == "nthreads":
+            options[key] = max(int_we(value, key), 1)
+        elif key == "quad_decimate":
+            options[key] = max(float_we(value, key), 1.0)
+        elif key == "quad_blur":
+            options[key] = max(float_we(value, key), 0.0)
+        else:
+            options[key] = bool_we(value, key)
+    return options
 
-def l2_preprocess(image, **kwargs):
-    # TODO: make stuff scale to image size
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-    edges = cv2.Canny(gray_image, 
-        get_with_type(kwargs, "canny_threshold_1", 50), get_with_type(kwargs, "canny_threshold_1", 150))
-    kernel = np.ones([get_with_type(kwargs, "edge_refinement_kernel_size", 3), 
-        get_with_type(kwargs, "edge_refinement_kernel_size", 3)], np.uint8)
-    dilated = cv2.dilate(edges, kernel, 1)
+def convert_tag_filter(values, tag_filter):
+    """
+    Convert AprilTag filters received from the client. Like in set_camera_params, empty values are skipped, and None
+    turns a filter off.
+    :param values: Dictionary of filter names to values. Names not in TAG_FILTER are ignored. tag_ids can be a list, a
+    single ID, or a string of comma separated IDs.
+    :param tag_filter: The current filters.
+    :return: A copy of tag_filter updated with values.
+    """
+    tag_filter = dict(tag_filter)
+    for key, value in values.items():
+        if key not in TAG_FILTER or value == '':
+            continue
+        if value is None:
+            tag_filter[key] = TAG_FILTER[key] if key == "min_decision_margin" else None
+        elif key == "tag_ids":
+            if isinstance(value, str):
+                value = [tag_id for tag_id in value.strip("[] ").split(",") if tag_id.strip()]
+            elif not isinstance(value, list):
+                value = [value]
+            tag_filter[key] = sorted({int_we(tag_id, key) for tag_id in value})
+        elif key == "tag_family":
+            tag_filter[key] = str(value)
+        elif key == "min_decision_margin":
+            tag_filter[key] = max(float_we(value, key), 0.0)
+        else:
+            tag_filter[key] = max(int_we(value, key), 0)
+    return tag_filter
 
-    closed = cv2.morphologyEx(dilated, cv2.MORPH_CLOSE, kernel, iterations=1)
 
-    thresh = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 
-        get_with_type(kwargs, "threshold_block_size", 35), get_with_type(kwargs, "threshold_offset", 3))
+# The saved parameters of every camera, by serial number
+CAMERA_PARAMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "camera-params.json")
 
-    highlighted = cv2.bitwise_and(thresh, thresh, closed)
-    return highlighted
 
+def load_camera_params():
+    """
+    :return: The contents of .cache/camera-params.json, or an empty dictionary if it is missing or unreadable.
+    """
+    try:
+        with open(CAMERA_PARAMS_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
 
-def l1_preprocess(image, **kwargs):
-    # TODO: make stuff scale to image size
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-    thresh = cv2.adaptiveThreshold(gray_image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 
-        get_with_type(kwargs, "threshold_block_size", 35), get_with_type(kwargs, "threshold_offset", 3))
+def save_camera_params(serial_number, values):
+    """
+    Save parameters of a camera to .cache/camera-params.json. The camera's other parameters and the other cameras'
+    are kept.
+    :param values: Dictionary of the parameters to save.
+    """
+    camera_params = load_camera_params()
+    camera_params.setdefault(serial_number, {}).update(values)
+    os.makedirs(os.path.dirname(CAMERA_PARAMS_PATH), exist_ok=True)
+    with open(CAMERA_PARAMS_PATH, 'w') as f:
+        json.dump(camera_params, f, indent=4)
 
-    highlighted = cv2.bitwise_and(thresh, thresh, gray_image)
-    return highlighted
 
 class CameraFunctionalObject:
 
@@ -169,8 +229,6 @@ class CameraFunctionalObject:
     TODO: Consolidate VP functions into one -----
     TODO: Further optimize combined VP funcitons
     TODO: Truely implement testing mode
-    TODO: Implement Scaling
-    TODO: Implement time for Apriltag
     """
     def __init__(self, name, serial_number, host_data=None):
         # This dictionary contains all the commands availible on the coprocessor. If you add a function, make sure to
@@ -185,32 +243,54 @@ class CameraFunctionalObject:
             "piece": self.piece,
             "apriltag": self.apriltag,
             "info": self.info,
+            "time_sync": self.time_sync,
+            "set_detector_options": self.set_detector_options,
+            "set_field_layout": self.set_field_layout,
+            "set_tag_filter": self.set_tag_filter,
+            "apriltag_stream": self.apriltag_stream,
+            "stop_stream": self.stop_stream,
             "function_info": self.function_info,
         }
 
         self.name = name
 
-        options = DetectorOptions(refine_edges=False)
-        self.detector = Detector(options=options)
         self.name = name
         self.serial_number = serial_number
-        self.previous_image = None
-        self.previous_image_information = None
-        self.previous_image_color = None
-
-        temp_camera = cv2.VideoCapture(name)
-        if temp_camera.isOpened():
-            temp_camera.release()
-            
-
-        # Open the camera and check if it works
-        self.camera = cv2.VideoCapture(name)
-        self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))  # Set the codec to MJPG,
+        # The detector options are saved per camera, see set_detector_options
+        self.detector_options = self.load_detector_options()
+        self.detector = Detector(options=DetectorOptions(**self.detector_options))
+        # The tag filters are saved per camera too, see set_tag_filter
+        self.tag_filter = self.load_tag_filter()
+        # Remembers where the tags were on the last frame, for apriltag's tracking mode
+        self.tag_tracker = TagTracker(self.detector)
+        # Follows the tags between frames for apriltag's predict
+        self.motion_filter = TagMotionFilter()
+        # (sequence, tags, extra) of the last frame detected for predict, so polling it again only predicts again
+        self.predicted_frame = (None, None, None)
+        self.preprocess_selector = PreprocessSelector()
+        # Detection, pose estimation and JPEG encoding run on these threads so the event loop can keep answering other
+        # messages. The detector, the tracker and the preprocessing buffers are shared, so detection holds
+        # detector_lock. The threads are only started on first use, in the server's process.
+        self.executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix=f"worker-{serial_number}")
+        self.detector_lock = threading.Lock()
+        # Running apriltag_stream pipelines, by websocket: (Pipeline, sending task)
+        self.streams = {}
+        # (modification time, FieldLayout) of .cache/field-layout.json, see load_field_layout
+        self.field_layout = (None, None)
+
+        # Open the camera and check if it works. The grabber owns the camera from here on; its capture thread is
+        # started by start() in the server process.
+        self.grabber = FrameGrabber(name)
+        self.grabber.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))  # Set the codec to MJPG,
         # as it is compatible with most cameras.
-        cam_works, _ = self.get_image()
+        cam_works, _ = self.grabber.read_once()
         if not cam_works:
             print(f"Camera {name} not found.")
         
+        # Camera properties (see cv2_props_dict) set explicitly in the camera parameters. Mode negotiation leaves these
+        # alone.
+        self.manual_camera_properties = set()
+
         # load the camera data from the JSON file
         try:
             base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -227,10 +307,14 @@ class CameraFunctionalObject:
             self.vertical_field_of_view = max(camera_params[serial_number]["vertical_field_of_view_radians"], 0)
             self.downscale_factor = max(camera_params[serial_number]["downscale_factor"], 1)
             self.record = bool(camera_params[serial_number]["record"])
+            self.capture_mode = camera_params[serial_number].get("capture_mode", CAPTURE_MODE)
+            if self.capture_mode not in CAPTURE_MODES:
+                self.capture_mode = CAPTURE_MODE
 
             for key in cv2_props_dict:
                 try:
-                    self.camera.set(cv2_props_dict[key], int_we(camera_params[serial_number][key], key))
+                    self.grabber.set(cv2_props_dict[key], int_we(camera_params[serial_number][key], key))
+                    self.manual_camera_properties.add(key)
                 except KeyError:
                     pass
 
@@ -247,6 +331,7 @@ class CameraFunctionalObject:
             self.vertical_field_of_view = CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS
             self.downscale_factor = DOWNSCALE_FACTOR
             self.record = RECORD
+            self.capture_mode = CAPTURE_MODE
 
             # Overwrite the parameters in the file with the defaults
             base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -263,7 +348,8 @@ class CameraFunctionalObject:
                 "horizontal_field_of_view_radians": self.horizontal_field_of_view,
                 "vertical_field_of_view_radians": self.vertical_field_of_view,
                 "downscale_factor": self.downscale_factor,
-                "record": self.record
+                "record": self.record,
+                "capture_mode": self.capture_mode
             }
             with open(data_path, 'w') as f:
                 json.dump(camera_params, f, indent=4)
@@ -279,6 +365,7 @@ class CameraFunctionalObject:
             self.vertical_field_of_view = CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS
             self.downscale_factor = DOWNSCALE_FACTOR
             self.record = RECORD
+            self.capture_mode = CAPTURE_MODE
             camera_params = {f"{serial_number}": {"horizontal_focal_length": self.horizontal_focal_length,
                                          "vertical_focal_length": self.vertical_focal_length,
                                          "camera_height": self.camera_height,
@@ -287,16 +374,32 @@ class CameraFunctionalObject:
                                          "tilt_angle_radians": self.tilt_angle_radians,
                                          "horizontal_field_of_view_radians": self.horizontal_field_of_view,
                                          "vertical_field_of_view_radians": self.vertical_field_of_view,
-                                         "downscale_factor": self.downscale_factor}}
+                                         "downscale_factor": self.downscale_factor,
+                                         "capture_mode": self.capture_mode}}
             base_dir = os.path.dirname(os.path.abspath(__file__))
             data_path = os.path.join(base_dir, ".cache", "camera-params.json")
             with open(data_path, 'w') as f:
                 json.dump(camera_params, f, indent=4)
 
+        self.grabber.set_capture_mode(self.capture_mode)
+
+        # Ask the camera for a mode matching the processing resolution instead of scaling every frame down. The modes
+        # are probed once and cached per serial number.
+        self.camera_modes = self.load_camera_modes()
+        self.camera_mode = None
+        self.apply_camera_mode()
+
+        # Reading a property from the camera is a driver round trip, so info serves them from this cache. It is refreshed
+        # when set_camera_params changes something, when the camera is reopened, or when info is called with refresh.
+        self.camera_properties = {}
+        self.camera_properties_generation = None
+        self.refresh_camera_properties()
+
         self.locater = Locater(self.camera_horizontal_resolution_pixels,
                                self.camera_vertical_resolution_pixels,
                                self.tilt_angle_radians, self.camera_height,
                                self.horizontal_field_of_view, self.vertical_field_of_view)
+        self.update_tag_constants()
         
         if self.record:
             fourcc = cv2.VideoWriter_fourcc(*'XVID')  # or 'XVID', 'MJPG', etc.
@@ -319,83 +422,216 @@ class CameraFunctionalObject:
             if not self.video_writer.isOpened():
                 raise RuntimeError(f"Could not open video writer for {video_filename}. Check permissions or path.") 
     
-    def get_image(self, rec_level=0):
-        if self.name == -1:
-            return True, cv2.imread("Coprocessor/images/resized_IMG_20250515_204201.jpg")
-        
-        ret, frame = self.camera.read()
-        try:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        except:
-            if rec_level <= 2:
-                self.camera.release()
-                time.sleep(2)
-                self.camera = cv2.VideoCapture(self.name)
-                return self.get_image(rec_level+1)
-            return None, None
-
-        if not ret:
-            self.camera.release()
-            self.camera = cv2.VideoCapture(self.name)
-            return None, None
-
-        return (ret, frame)
+    def start(self):
+        """
+        Start the background capture. Called by the server once it is running in its own process.
+        """
+        self.grabber.start()
+
+    def get_frame(self):
+        """
+        Get the newest frame captured by the grabber, along with its sequence number and capture timestamp. This never
+        waits for the camera, except for the first frame after startup or after a reconnect. If the camera is being
+        reconnected it returns None straight away.
+        :return: Frame or None
+        """
+        frame = self.grabber.latest_frame()
+        if frame is None and self.grabber.state == CAMERA_OK:
+            self.grabber.start()
+            frame = self.grabber.wait_for_frame(timeout=1)
+        return frame
+
+    async def run_in_worker(self, function, *args):
+        """
+        Run a blocking function on the worker threads and wait for its result without blocking the event loop.
+        Exceptions raised by the function are raised here.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def send_frame_result(self, websocket, data, frame, processed_time):
+        """
+        Send the result of processing a frame, stamped with the frame's timing information. All times come from
+        time.monotonic() on the coprocessor; use the time_sync command to relate them to the robot's clock.
+        :param data: The response dictionary.
+        :param frame: The Frame the response was computed from.
+        :param processed_time: The time at which processing of the frame finished.
+        """
+        await self.send_frame_message(websocket, frame_result_message(data, frame, processed_time))
+
+    async def send_frame_message(self, websocket, message):
+        """
+        Send a message made by frame_result_message, adding the send time.
+        """
+        # The send time is added after serializing the (possibly large) response so that it is as close to the actual
+        # send as possible.
+        await websocket.send(message[:-1] + f', "send_time": {time.monotonic()}}}')
     
-    def save_frame(self, frame, text, color):
+    def save_frame(self, frame, text, color, color_space=COLOR_BGR):
         """
         Saves a frame to the video writer with a text overlay.
         :param frame: The frame to save.
         :param text: The text to overlay on the frame.
-        :param color: The color of the text overlay.
+        :param color: The color of the text overlay, in BGR.
+        :param color_space: The color space of the frame. It is only converted if it is not BGR already.
         """
         if self.record:
             try:
-                frame_to_write = cv2.cvtColor(draw_image_to_record(frame, text=text, color=color), cv2.COLOR_RGB2BGR)
+                frame_to_write = draw_image_to_record(convert_color(frame, color_space, COLOR_BGR), text=text, color=color)
                 self.video_writer.write(frame_to_write)
             except Exception as e:
                 print(f"Error writing to video file: {e}")
     
     
+    def load_camera_modes(self):
+        """
+        Get the modes the camera supports from .cache/camera-params.json. If they aren't cached yet the camera is
+        probed and the result is saved, so later boots skip the probe. Delete "camera_modes" from the file to probe
+        again.
+        :return: List of modes, see CaptureBackend.list_modes
+        """
+        modes = load_camera_params().get(self.serial_number, {}).get("camera_modes")
+        if modes is not None:
+            return modes
+
+        modes = self.grabber.list_modes()
+        if modes:
+            # Only cache a successful probe, a camera that isn't working now is probed again on the next boot
+            save_camera_params(self.serial_number, {"camera_modes": modes})
+        return modes
+
+    def load_detector_options(self):
+        """
+        Get the AprilTag detector options for this camera from .cache/camera-params.json. Options that aren't saved
+        there (or are invalid) come from DETECTOR_OPTIONS.
+        :return: Dictionary of detector options
+        """
+        camera_params = load_camera_params().get(self.serial_number, {})
+        try:
+            return convert_detector_options(camera_params.get("detector_options", {}), DETECTOR_OPTIONS)
+        except (ValueError, AttributeError) as e:
+            print(f"Invalid detector options in camera-params.json, using the defaults. {e}")
+            return dict(DETECTOR_OPTIONS)
+
+    def load_tag_filter(self):
+        """
+        Get the AprilTag filters for this camera from .cache/camera-params.json. Filters that aren't saved there (or are
+        invalid) come from TAG_FILTER.
+        :return: Dictionary of filters
+        """
+        camera_params = load_camera_params().get(self.serial_number, {})
+        try:
+            return convert_tag_filter(camera_params.get("tag_filter", {}), TAG_FILTER)
+        except (ValueError, AttributeError) as e:
+            print(f"Invalid tag filter in camera-params.json, using the defaults. {e}")
+            return dict(TAG_FILTER)
+
+    def request_tag_filter(self, **values):
+        """
+        Combine the filters passed to a request with this camera's. Filters that are not passed (None) keep the
+        camera's value.
+        :return: TagFilter for the detector
+        """
+        return TagFilter(**convert_tag_filter({key: value for key, value in values.items() if value is not None},
+                                              self.tag_filter))
+
+    def apply_camera_mode(self):
+        """
+        Switch the camera to the cheapest mode that delivers the processing resolution in a format suited to the capture
+        mode. If the camera's modes are unknown it is simply asked for the processing resolution. Frame size and FPS set
+        explicitly in the camera parameters take precedence.
+        """
+        if self.manual_camera_properties & {"frame_width", "frame_height"}:
+            return
+        mode = pick_camera_mode(self.camera_modes, self.camera_horizontal_resolution_pixels,
+                                self.camera_vertical_resolution_pixels, CAPTURE_FORMATS[self.capture_mode])
+        self.camera_mode = mode
+        if mode is None:
+            self.grabber.set(cv2.CAP_PROP_FRAME_WIDTH, self.camera_horizontal_resolution_pixels)
+            self.grabber.set(cv2.CAP_PROP_FRAME_HEIGHT, self.camera_vertical_resolution_pixels)
+            return
+
+        # V4L2 needs the format before the size, the size limits the frame rates available
+        self.grabber.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*mode["format"]))
+        self.grabber.set(cv2.CAP_PROP_FRAME_WIDTH, mode["width"])
+        self.grabber.set(cv2.CAP_PROP_FRAME_HEIGHT, mode["height"])
+        if "fps" not in self.manual_camera_properties:
+            self.grabber.set(cv2.CAP_PROP_FPS, mode["fps"])
+
+    def refresh_camera_properties(self):
+        """
+        Read all the camera properties in cv2_props_dict into the cache. Properties that can't be read (e.g. while the
+        camera is reconnecting) keep their previous value.
+        """
+        for key in cv2_props_dict:
+            try:
+                value = self.grabber.get(cv2_props_dict[key])
+            except:
+                continue
+            if value is not None:
+                self.camera_properties[key] = value
+        self.camera_properties_generation = self.grabber.generation
+
     async def report_no_cams(self, websocket):
         await websocket.send('{"error":"This function is not availible when no camera is detected."}')
 
-    async def raw(self, websocket, quality=0.9, **kwargs):
+    async def report_capture_error(self, websocket):
+        """
+        Tell the client that no frame is available. Includes the camera state so the client can tell a camera that is
+        being reconnected (try again shortly) from one that is lost.
+        """
+        error = {"error": "Failed to capture image"}
+        error.update(self.grabber.health())
+        await websocket.send(json.dumps(error))
+
+    async def raw(self, websocket, quality=None, passthrough=False, **kwargs):
         """
         This function captures an image from the camera and sends it to the client. It does not do any processing.
+        In mjpeg capture mode the camera's own JPEG is forwarded without decoding it when no quality is requested and
+        the downscale factor is 1, or when passthrough is requested explicitly.
         :param websocket:
         :return:
         """
-        # Attempt to get a frame from the camera
-        ret, frame = self.get_image()
-        if not ret:
-
-            await websocket.send('{"error": "Failed to capture image"}')
+        passthrough = bool_we(passthrough, "passthrough")
+        captured = self.get_frame()
+        if captured is None:
+            await self.report_capture_error(websocket)
             return
 
-        # Convert the frame to RGB for visualization and resize it to the processing scale
-        try:
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            #img = cv2.resize(img, (self.camera_horizontal_resolution_pixels // self.processing_scale,
-            #                       self.camera_vertical_resolution_pixels // self.processing_scale))
-        except Exception as e:
-            await websocket.send('{"error": "' + str(e) + '"}')
+        if captured.jpeg is not None and (passthrough or (quality is None and self.downscale_factor == 1)):
+            jpg_string = base64.b64encode(captured.jpeg).decode('utf-8')
+            if self.record:
+                self.save_frame(captured.get(COLOR_BGR), text="Raw Image", color=(255, 255, 255))
+            await self.send_frame_result(websocket, {"image_string":jpg_string}, captured, time.monotonic())
             return
-        
-        img = cv2.resize(img, (img.shape[1] // self.downscale_factor, img.shape[0] // self.downscale_factor))
-        image_array = np.asarray(img)
+
+        quality = 0.9 if quality is None else float_we(quality, "quality")
+        jpg_string = await self.run_in_worker(self.encode_raw, captured, quality)
+        # The video writer is only used from the event loop, so the frame is recorded here rather than on the worker
         if self.record:
-            self.save_frame(frame, text="Raw Image", color=(255, 255, 255))
+            self.save_frame(captured.get(COLOR_BGR), text="Raw Image", color=(255, 255, 255))
+
+        # Send the image to the client
+        await self.send_frame_result(websocket, {"image_string":jpg_string}, captured, time.monotonic())
 
+    def encode_raw(self, captured, quality):
+        """
+        Scale a frame down to the processing size and encode it, for raw. Runs on a worker thread.
+        :return: The JPEG as a base64 string.
+        """
+        # JPEG encoding takes BGR, which is what the camera gives us, so no conversion is needed
+        frame = captured.get(COLOR_BGR)
+
+        img = cv2.resize(frame, (frame.shape[1] // self.downscale_factor, frame.shape[0] // self.downscale_factor))
+        image_array = np.asarray(img)
         encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality*100)]
         _, encoded_img = cv2.imencode('.jpg', image_array, encode_param)
-    
-        jpg_string = base64.b64encode(encoded_img).decode('utf-8')
-        
 
-        # Send the image to the client
-        await websocket.send(json.dumps({"image_string":jpg_string}))
+        return base64.b64encode(encoded_img).decode('utf-8')
 
-    async def apriltag(self, websocket, return_image=False, preprocessing_mode="3", quality=0.9, preprocessor_parameters="{}", **kwargs):
+    async def apriltag(self, websocket, return_image=False, preprocessing_mode="3", quality=0.9, preprocessor_parameters="{}",
+                       tracking=False, rescan_interval=None, decimation=1, pyramid=False,
+                       min_tag_pixels=PYRAMID_MIN_TAG_PIXELS, field_pose=False, tag_ids=None, tag_family=None,
+                       min_decision_margin=None, max_hamming=None, predict=False, **kwargs):
         """
         This function captures an image from the camera, detects AprilTags in the image, and returns the image with
         dots on the corners and center to show the detected AprilTags.
@@ -403,93 +639,358 @@ class CameraFunctionalObject:
         :return:
         """
         # Capture an image frame
-        ret, frame = self.get_image()
-        if not ret:
-
-            await websocket.send('{"error": "Failed to capture image"}')
+        captured = self.get_frame()
+        if captured is None:
+            await self.report_capture_error(websocket)
             return
-        print(frame.shape)
-        # TODO: Do the processingscale thing
-        # frame = cv2.resize(frame, (int(self.camera_horizontal_resolution_pixels / self.processing_scale),
-        #                           int(self.camera_vertical_resolution_pixels / self.processing_scale)))
-        
-        processed_image = None
-        if preprocessing_mode == "0":
-            processed_image = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        elif preprocessing_mode == "1":
-            processed_image = l1_preprocess(frame)
-        elif preprocessing_mode == "2":
-            processed_image = l2_preprocess(frame)
-        elif preprocessing_mode == "3":
-            processed_image = l3_preprocess(frame)
-            
-        # Detect AprilTags in the image
-        tags = self.detector.detect(processed_image)
 
-        # Convert the frame to RGB for visualization
-        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        preprocessing_mode = convert_preprocessing_mode(preprocessing_mode)
+        decimation = max(float_we(decimation, "decimation"), 1)
+        tracking = bool_we(tracking, "tracking")
+        pyramid = bool_we(pyramid, "pyramid")
+        if rescan_interval is not None:
+            rescan_interval = max(int_we(rescan_interval, "rescan_interval"), 0)
+        min_tag_pixels = float_we(min_tag_pixels, "min_tag_pixels")
+        field_pose = bool_we(field_pose, "field_pose")
+        predict = bool_we(predict, "predict")
+        tag_filter = self.request_tag_filter(tag_ids=tag_ids, tag_family=tag_family,
+                                             min_decision_margin=min_decision_margin, max_hamming=max_hamming)
+
+        # Detection, pose estimation and encoding block for a while, so they run on a worker thread
+        data = await self.run_in_worker(self.process_apriltag, captured, return_image, quality, preprocessing_mode,
+                                        preprocessor_parameters, tracking, rescan_interval, decimation, pyramid,
+                                        min_tag_pixels, tag_filter, field_pose, predict)
+        await self.send_frame_result(websocket, data, captured, time.monotonic())
+
+    def process_apriltag(self, captured, return_image, quality, preprocessing_mode, preprocessor_parameters, tracking,
+                         rescan_interval, decimation, pyramid, min_tag_pixels, tag_filter, field_pose, predict):
+        """
+        The work behind apriltag, see its arguments. Runs on a worker thread.
+        :return: The response dictionary, without the timing fields.
+        """
+        # The detector, the tracker, the selector and the preprocessing buffers are shared between the workers
+        with self.detector_lock:
+            sequence, tags, extra = self.predicted_frame
+            # With predict the robot may poll faster than the camera runs. The motion filter has the tags of a frame
+            # it has seen already, so only the prediction has to be worked out again.
+            if not predict or sequence != captured.sequence:
+                # Tag detection only needs the luma, so go straight to grayscale
+                gray_image = captured.get(COLOR_GRAY)
+                tags, extra = self.detect_apriltags(gray_image, captured.sequence, preprocessing_mode,
+                                                    preprocessor_parameters, tracking, rescan_interval, decimation,
+                                                    pyramid, min_tag_pixels, tag_filter)
+                if predict:
+                    self.predicted_frame = (captured.sequence, tags, extra)
+
+        return self.apriltag_result(captured, tags, extra, return_image, quality, field_pose, predict)
+
+    def apriltag_result(self, captured, tags, extra, return_image, quality, field_pose, predict):
+        """
+        Build the response of apriltag and apriltag_stream from the detected tags.
+        :param extra: Extra fields returned by detect_apriltags.
+        :return: The response dictionary, without the timing fields.
+        """
+        data = {"tags": self.tag_poses(tags)}
+        data.update(extra)
+        if field_pose:
+            data["field_pose"] = self.field_pose(tags)
+        if return_image:
+            data["image_string"] = self.encode_tag_image(captured, tags, quality)
+        if predict:
+            # Predicted last, so the prediction is as close as possible to the send
+            self.motion_filter.update(data["tags"], captured.timestamp, captured.sequence)
+            data["prediction_time"] = time.monotonic()
+            data["predictions"] = self.motion_filter.predict(data["prediction_time"],
+                                                             {tag["tag_id"] for tag in data["tags"]})
+        return data
+
+    def update_tag_constants(self):
+        """
+        Work out the per camera constants used by tag_poses. Call this whenever the camera parameters change.
+        """
+        horizontal_correspondant = (np.tan(self.horizontal_field_of_view / 2.0) /
+                                    (self.camera_horizontal_resolution_pixels / 2.0))
+        vertical_correspondant = (np.tan(self.vertical_field_of_view / 2.0) /
+                                  (self.camera_vertical_resolution_pixels / 2.0))
+        max_vertical_angle = self.camera_vertical_resolution_pixels * vertical_correspondant
+
+        # Swapped in as a whole so a worker in the middle of tag_poses never sees half of an update
+        self.tag_constants = {
+            "camera": (self.horizontal_focal_length, self.vertical_focal_length,
+                       self.camera_horizontal_resolution_pixels / 2, self.camera_vertical_resolution_pixels / 2),
+            "horizontal_distance_scale": APRIL_TAG_WIDTH * self.horizontal_focal_length,
+            "vertical_distance_scale": APRIL_TAG_HEIGHT * self.vertical_focal_length,
+            "horizontal_correspondant": horizontal_correspondant,
+            "horizontal_offset": self.horizontal_field_of_view * 0.5,
+            "vertical_correspondant": vertical_correspondant,
+            "vertical_offset": max_vertical_angle + self.tilt_angle_radians - self.vertical_field_of_view * 0.5,
+        }
+
+    def tag_poses(self, tags):
+        """
+        Work out the position, orientation, distance and direction of detected tags.
+        :param tags: Detection array from detect_apriltags.
+        :return: List of dictionaries, as returned by apriltag.
+        """
+        if len(tags) == 0:
+            return []
+
+        # Everything is worked out for all the tags at once from the detection array
+        constants = self.tag_constants
+        corners = tags["corners"]
+        centers = tags["center"]
+
+        # Calculate distances using tag corners
+        distance_horizontal = constants["horizontal_distance_scale"] / np.linalg.norm(corners[:, 0] - corners[:, 1],
+                                                                                      axis=1)
+        distance_vertical = constants["vertical_distance_scale"] / np.linalg.norm(corners[:, 1] - corners[:, 2],
+                                                                                  axis=1)
+        distance_avg = (distance_horizontal + distance_vertical) / 2
+
+        # Calculate the direction to the tags
+        angle_radians_horiz = centers[:, 0] * constants["horizontal_correspondant"] - constants["horizontal_offset"]
+        angle_radians_vert = constants["vertical_offset"] - centers[:, 1] * constants["vertical_correspondant"]
+
+        # Pose estimation to get the translation and rotation vectors
+        rotations, translations, _ = TagPose.tag_poses(tags, *constants["camera"], APRIL_TAG_WIDTH)
+        orientations = TagPose.rotation_vectors(rotations)
+
+        return [{"tag_id": tag_id, "position": position, "orientation": orientation, "distance": distance,
+                 "horizontal_angle": horizontal_angle, "vertical_angle": vertical_angle}
+                for tag_id, position, orientation, distance, horizontal_angle, vertical_angle
+                in zip(tags["tag_id"].tolist(), translations.tolist(), orientations.tolist(), distance_avg.tolist(),
+                       angle_radians_horiz.tolist(), (-angle_radians_vert).tolist())]
+
+    def load_field_layout(self):
+        """
+        Get the field layout from .cache/field-layout.json. It is only read again when the file changes, so a new layout
+        is picked up without a restart.
+        :return: The FieldLayout, or None if there is no valid layout.
+        """
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        data_path = os.path.join(base_dir, ".cache", "field-layout.json")
+        try:
+            modified = os.path.getmtime(data_path)
+        except OSError:
+            return None
 
-        tag_list = []
+        cached_modified, layout = self.field_layout
+        if modified != cached_modified:
+            try:
+                with open(data_path, 'r') as f:
+                    layout = TagPose.FieldLayout(json.load(f), APRIL_TAG_WIDTH)
+            except (OSError, ValueError) as e:
+                print(f"Could not load the field layout. {e}")
+                layout = None
+            self.field_layout = (modified, layout)
+        return layout
+
+    def field_pose(self, tags):
+        """
+        Find the pose of the camera on the field with one solve over the corners of every detected tag in the field
+        layout.
+        :param tags: Detection array from detect_apriltags.
+        :return: Dictionary as returned by apriltag in field_pose, or None if there is no layout or no tag of the layout
+        was detected.
+        """
+        layout = self.load_field_layout()
+        if layout is None:
+            return None
+        pose = layout.camera_pose(tags, *self.tag_constants["camera"])
+        if pose is None:
+            return None
+        position, rotation, error, tag_ids = pose
+        return {"position": position.tolist(),
+                "orientation": TagPose.rotation_vectors(rotation[None])[0].tolist(),
+                "reprojection_error": error,
+                "tag_ids": tag_ids.tolist()}
+
+    def encode_tag_image(self, captured, tags, quality):
+        """
+        Draw the detected tags on the frame, scaled down to the processing size, and encode it.
+        :return: The JPEG as a base64 string.
+        """
+        # Resizing makes a copy, so drawing on it does not touch the captured frame
+        img = captured.get(COLOR_BGR)
+        img = cv2.resize(img, (img.shape[1] // self.downscale_factor, img.shape[0] // self.downscale_factor))
 
         for tag in tags:
-            # Calculate distances using tag corners
-            distance_horizontal = (APRIL_TAG_WIDTH * self.horizontal_focal_length) / np.linalg.norm(
-                np.array(tag["corners"][0]) - np.array(tag["corners"][1]))
-            distance_vertical = (APRIL_TAG_HEIGHT * self.vertical_focal_length) / np.linalg.norm(
-                np.array(tag["corners"][1]) - np.array(tag["corners"][2]))
-            distance_avg = (distance_horizontal + distance_vertical) / 2
-
-            # Pose estimation to get the translation vector
-            pose_R, pose_T, init_error, final_error = (
-                self.detector.detection_pose(tag, [self.horizontal_focal_length,
-                                                   self.vertical_focal_length,
-                                                   self.camera_horizontal_resolution_pixels / 2,
-                                                   self.camera_vertical_resolution_pixels / 2],
-                                             APRIL_TAG_WIDTH))
-            euler_angles = cv2.Rodrigues(pose_R)[0].flatten()
-
-            # Calculate the direction to the tag
-            horizontal_correspondant = (np.tan(self.horizontal_field_of_view / 2.0) /
-                                       (self.camera_horizontal_resolution_pixels / 2.0))
-
-            angle_radians_horiz = ((tag["center"][0] * horizontal_correspondant) -
-                                   self.horizontal_field_of_view * 0.5)
-
-            vertical_correspondant = (np.tan(self.vertical_field_of_view / 2.0) /
-                                        (self.camera_vertical_resolution_pixels / 2.0))
-            max_vertical_angle = self.camera_vertical_resolution_pixels * vertical_correspondant
-
-            angle_radians_vert = ((max_vertical_angle - tag["center"][1] * (np.tan(self.vertical_field_of_view / 2.0) /
-                                     (self.camera_vertical_resolution_pixels / 2.0))) +
-                                  self.tilt_angle_radians - self.vertical_field_of_view * 0.5)
-
-            tag_list.append(
-                {"tag_id": tag["tag_id"], "position": pose_T.flatten().tolist(), "orientation": euler_angles.tolist(),
-                 "distance": distance_avg, "horizontal_angle": angle_radians_horiz, "vertical_angle": -angle_radians_vert}) # TODO: Add Time
-        
-        data = {"tags": tag_list}
+            # Visualization
+            cv2.circle(img, (int(tag["center"][0]), int(tag["center"][1])), 5, (255, 0, 0), -1)
+            for corner in tag["corners"]:
+                cv2.circle(img, (int(corner[0]), int(corner[1])), 3, (0, 255, 0), -1)
 
-        if return_image:
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            img = cv2.resize(img, (img.shape[1] // self.downscale_factor, img.shape[0] // self.downscale_factor))
-
-            for tag in tags:
-                # Visualization
-                cv2.circle(img, (int(tag["center"][0]), int(tag["center"][1])), 5, (255, 0, 0), -1)
-                for corner in tag["corners"]:
-                    cv2.circle(img, (int(corner[0]), int(corner[1])), 3, (0, 255, 0), -1)
-
-            image_array = np.asarray(img)
-            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality*100)]
-            _, encoded_img = cv2.imencode('.jpg', image_array, encode_param)
-        
-            jpg_string = base64.b64encode(encoded_img).decode('utf-8')
-            
-            data["image_string"] = jpg_string
+        image_array = np.asarray(img)
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality*100)]
+        _, encoded_img = cv2.imencode('.jpg', image_array, encode_param)
 
-        
+        return base64.b64encode(encoded_img).decode('utf-8')
 
-        await websocket.send(json.dumps(data))
+    def detect_apriltags(self, gray_image, sequence, preprocessing_mode, preprocessor_parameters, tracking,
+                         rescan_interval, decimation, pyramid, min_tag_pixels, tag_filter):
+        """
+        Find the AprilTags in a grayscale frame. Hold detector_lock while calling this.
+        :param tag_filter: TagFilter for this request. Rejected tags are dropped by the detector itself, before any pose
+        work, and are not tracked.
+        :return: The detection array, and a dictionary of the extra fields for the response (full_scan, pyramid_level and
+        preprocessing_mode, when they apply).
+        """
+        self.detector.tag_filter = tag_filter
+
+        # In auto mode the selector picks the cheapest mode that still finds the tags, and times it
+        auto_preprocess = str(preprocessing_mode) == AUTO_MODE
+        if auto_preprocess:
+            preprocessing_mode = self.preprocess_selector.choose()
+        # The pipeline for these parameters is built on first use and reused after that
+        preprocess = get_preprocessor(preprocessing_mode, preprocessor_parameters)
+        if auto_preprocess:
+            preprocess = self.preprocess_selector.timed(preprocess)
+
+        # Detect AprilTags in the image. In tracking mode only the regions around the tags from the last frame are
+        # searched, with a search of the whole frame every rescan_interval frames or when a tag is lost. With a
+        # decimation above 1 the search runs on a shrunk image and the corners are refined on the full one.
+        # In pyramid mode the whole frame is searched at low resolution first, and at higher resolutions only near the
+        # horizon if nothing or only small tags were found.
+        full_search = None
+        pyramid_level = None
+        if pyramid:
+            focal_length = self.vertical_focal_length * gray_image.shape[0] / self.camera_vertical_resolution_pixels
+            band = horizon_band(gray_image.shape[0], focal_length, self.tilt_angle_radians)
+
+            def full_search(image):
+                nonlocal pyramid_level
+                found, pyramid_level = detect_pyramid(self.detector, image, preprocess, PYRAMID_LEVELS, band,
+                                                      min_tag_pixels)
+                return found
+
+        detection_start = time.perf_counter()
+        if tracking:
+            tags, full_scan = self.tag_tracker.detect(gray_image, preprocess, sequence, rescan_interval, decimation,
+                                                      full_search)
+        else:
+            self.tag_tracker.reset()
+            if full_search is not None:
+                tags = full_search(gray_image)
+            else:
+                tags = detect_scaled(self.detector, gray_image, preprocess, decimation)
+        if auto_preprocess:
+            self.preprocess_selector.record(preprocessing_mode, len(tags), time.perf_counter() - detection_start)
+
+        extra = {}
+        if tracking:
+            extra["full_scan"] = full_scan
+        if pyramid_level is not None:
+            extra["pyramid_level"] = pyramid_level
+        if auto_preprocess:
+            extra["preprocessing_mode"] = preprocessing_mode
+        return tags, extra
+
+    async def apriltag_stream(self, websocket, return_image=False, preprocessing_mode="3", quality=0.9,
+                              preprocessor_parameters="{}", tracking=False, rescan_interval=None, decimation=1,
+                              pyramid=False, min_tag_pixels=PYRAMID_MIN_TAG_PIXELS, field_pose=False, tag_ids=None,
+                              tag_family=None, min_decision_margin=None, max_hamming=None, predict=False, **kwargs):
+        """
+        Send the apriltag result for every new frame until stop_stream is called or the connection closes. The work is
+        split into stages that run at the same time on consecutive frames: converting a frame to grayscale, detecting
+        the tags, and working out their poses and encoding the response. A stage that is still busy when the next frame
+        arrives drops the older frame, so results are never stale. The arguments are the same as for apriltag.
+        """
+        preprocessing_mode = convert_preprocessing_mode(preprocessing_mode)
+        decimation = max(float_we(decimation, "decimation"), 1)
+        tracking = bool_we(tracking, "tracking")
+        pyramid = bool_we(pyramid, "pyramid")
+        if rescan_interval is not None:
+            rescan_interval = max(int_we(rescan_interval, "rescan_interval"), 0)
+        min_tag_pixels = float_we(min_tag_pixels, "min_tag_pixels")
+        field_pose = bool_we(field_pose, "field_pose")
+        predict = bool_we(predict, "predict")
+        tag_filter = self.request_tag_filter(tag_ids=tag_ids, tag_family=tag_family,
+                                             min_decision_margin=min_decision_margin, max_hamming=max_hamming)
+
+        # Only one stream per connection
+        await self.stop_stream(websocket, reply=False)
+
+        last_sequence = 0
+
+        def next_frame():
+            nonlocal last_sequence
+            frame = self.grabber.wait_for_frame(last_sequence, timeout=0.5)
+            if frame is None:
+                return None
+            last_sequence = frame.sequence
+            return frame
+
+        def convert(frame):
+            # The frame keeps the converted image, so the detection stage gets it for free
+            frame.get(COLOR_GRAY)
+            return frame
+
+        def detect(frame):
+            with self.detector_lock:
+                tags, extra = self.detect_apriltags(frame.get(COLOR_GRAY), frame.sequence, preprocessing_mode,
+                                                    preprocessor_parameters, tracking, rescan_interval, decimation,
+                                                    pyramid, min_tag_pixels, tag_filter)
+            return frame, tags, extra
+
+        def encode(item):
+            frame, tags, extra = item
+            data = self.apriltag_result(frame, tags, extra, return_image, quality, field_pose, predict)
+            data["dropped_frames"] = pipeline.dropped
+            return frame_result_message(data, frame, time.monotonic())
+
+        loop = asyncio.get_running_loop()
+        messages = asyncio.Queue(maxsize=1)
+
+        def deliver(message):
+            # Runs on the event loop. Like the stages, the queue to the sender drops the older message.
+            if messages.full():
+                messages.get_nowait()
+            messages.put_nowait(message)
+
+        pipeline = Pipeline(next_frame, [convert, detect, encode],
+                            lambda message: loop.call_soon_threadsafe(deliver, message),
+                            name=f"stream-{self.serial_number}")
+        self.streams[websocket] = (pipeline, asyncio.create_task(self.send_stream(websocket, pipeline, messages)))
+        pipeline.start()
+
+    async def send_stream(self, websocket, pipeline, messages):
+        """
+        Send the messages of a streaming pipeline as they come out of it, until it stops or the connection fails.
+        """
+        try:
+            while pipeline.running:
+                try:
+                    message = await asyncio.wait_for(messages.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                await self.send_frame_message(websocket, message)
+            if pipeline.error is not None:
+                await websocket.send(json.dumps({"error": f"The stream stopped: {pipeline.error}"}))
+        except Exception as e:
+            print(f"Stream for {self.serial_number} stopped: {e}")
+        finally:
+            # Joining the stage threads can take a moment, so don't do it on the event loop
+            await stop_pipeline(pipeline)
+            if self.streams.get(websocket, (None,))[0] is pipeline:
+                del self.streams[websocket]
+
+    async def stop_stream(self, websocket, reply=True, **kwargs):
+        """
+        Stop the stream started by apriltag_stream on this connection, if there is one.
+        """
+        stream = self.streams.pop(websocket, None)
+        if stream is not None:
+            pipeline, task = stream
+            await stop_pipeline(pipeline)
+            await task
+        if reply:
+            await websocket.send(json.dumps({"streaming": False}))
+
+    async def close_connection(self, websocket):
+        """
+        Called by the server when a connection closes.
+        """
+        await self.stop_stream(websocket, reply=False)
 
     async def switch_color(self, websocket, new_color=0):
         """
@@ -608,6 +1109,13 @@ class CameraFunctionalObject:
             json_vals = kwargs
         else:
             json_vals = json.loads(kwargs)
+        # Checked before anything changes, so a bad mode does not leave the other parameters half applied
+        capture_mode = json_vals.get("capture_mode", '')
+        if capture_mode != '' and capture_mode not in CAPTURE_MODES:
+            await websocket.send(json.dumps({"error": f'Unknown capture mode "{capture_mode}". Use one of '
+                                                      f'{", ".join(CAPTURE_MODES)}.'}))
+            return
+        previous_resolution = (self.camera_horizontal_resolution_pixels, self.camera_vertical_resolution_pixels)
         try:
             self.horizontal_focal_length = json_vals["horizontal_focal_length"]
             self.vertical_focal_length = json_vals["vertical_focal_length"]
@@ -680,6 +1188,10 @@ class CameraFunctionalObject:
             if not self.video_writer.isOpened():
                 raise RuntimeError(f"Could not open video writer for {video_filename}. Check permissions or path.") 
 
+        if capture_mode != '' and capture_mode != self.capture_mode:
+            self.grabber.set_capture_mode(capture_mode)
+            self.capture_mode = capture_mode
+
         new_params = {
                 "horizontal_focal_length": self.horizontal_focal_length,
                 "vertical_focal_length": self.vertical_focal_length,
@@ -690,63 +1202,37 @@ class CameraFunctionalObject:
                 "horizontal_field_of_view_radians": self.horizontal_field_of_view,
                 "vertical_field_of_view_radians": self.vertical_field_of_view,
                 "downscale_factor": self.downscale_factor,
-                "record": self.record
+                "record": self.record,
+                "capture_mode": self.capture_mode
             }
 
+        properties_changed = capture_mode != ''
+        if properties_changed or previous_resolution != (self.camera_horizontal_resolution_pixels,
+                                                         self.camera_vertical_resolution_pixels):
+            self.apply_camera_mode()
+            properties_changed = True
+
         for key in cv2_props_dict:
             try:
                 if json_vals[key] == '':
                     continue
-                self.camera.set(cv2_props_dict[key], float_we(json_vals[key], key))
+                self.grabber.set(cv2_props_dict[key], float_we(json_vals[key], key))
                 new_params[key] = float_we(json_vals[key], key)
+                self.manual_camera_properties.add(key)
+                properties_changed = True
             except KeyError:
                 pass
-        
-        
-
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        data_path = os.path.join(base_dir, ".cache", "camera-params.json")
-        with open(data_path, 'r') as f:
-            camera_params = json.loads(f.read())
+        if properties_changed:
+            # Setting one property can change others (e.g. autoexposure and exposure), so read them all again
+            self.refresh_camera_properties()
 
-        try:
-            camera_params[self.serial_number] = new_params
-        except KeyError as e:
-            print("Camera name not found in camera-params.json or params are invalid. Using default values.")
-            self.horizontal_focal_length = HORIZONTAL_FOCAL_LENGTH
-            self.vertical_focal_length = VERTICAL_FOCAL_LENGTH
-            self.camera_height = CAMERA_HEIGHT
-            self.camera_horizontal_resolution_pixels = CAMERA_HORIZONTAL_RESOLUTION_PIXELS
-            self.camera_vertical_resolution_pixels = CAMERA_VERTICAL_RESOLUTION_PIXELS
-            self.tilt_angle_radians = 0
-            self.horizontal_field_of_view = CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS
-            self.vertical_field_of_view = CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS
-            self.downscale_factor = DOWNSCALE_FACTOR
-            self.record = RECORD
-
-            # Overwrite the parameters in the file with the defaults
-            with open(data_path, 'r') as f:
-                camera_params = json.loads(f.read())
-            camera_params[self.serial_number] = {
-                "horizontal_focal_length": self.horizontal_focal_length,
-                "vertical_focal_length": self.vertical_focal_length,
-                "camera_height": self.camera_height,
-                "horizontal_resolution_pixels": self.camera_horizontal_resolution_pixels,
-                "vertical_resolution_pixels": self.camera_vertical_resolution_pixels,
-                "tilt_angle_radians": self.tilt_angle_radians,
-                "horizontal_field_of_view_radians": self.horizontal_field_of_view,
-                "vertical_field_of_view_radians": self.vertical_field_of_view,
-                "downscale_factor": self.downscale_factor,
-                "record": self.record
-            }
-            websocket.send("Camera name not found in camera-params.json or params are invalid. Using default values.")
-        with open(data_path, 'w') as f:
-            json.dump(camera_params, f, indent=4)
+        save_camera_params(self.serial_number, new_params)
 
         self.locater = Locater(self.camera_horizontal_resolution_pixels,
                                self.camera_vertical_resolution_pixels,
                                self.tilt_angle_radians, self.camera_height,
                                self.horizontal_field_of_view, self.vertical_field_of_view)
+        self.update_tag_constants()
 
         await self.info(websocket)
 
@@ -758,12 +1244,15 @@ class CameraFunctionalObject:
         :param websocket:
         :return:
         """
-        ret, frame = self.get_image()
-        if not ret:
-
-            await websocket.send('{"error": "Failed to capture image"}')
+        captured = self.get_frame()
+        if captured is None:
+            await self.report_capture_error(websocket)
             return
-        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if captured.color_space == COLOR_GRAY:
+            await websocket.send('{"error": "Piece detection needs color. Set capture_mode to decoded or mjpeg."}')
+            return
+        # The Locater works on BGR images, the camera's native order
+        img = captured.get(COLOR_BGR)
         out_image = center = width = coefficient = jpg_string = None
         if return_image or self.record:
             out_image, center, width, coefficient = self.locater.locate(
@@ -784,17 +1273,14 @@ class CameraFunctionalObject:
 
                 self.save_frame(out_image,
                         text=f"Piece Detection. \nCenter: ({center_percent[0]:.1f}%, {center_percent[1]:.1f}%)\nWidth: {width_percent:.1f}%",
-                        color=((255, 128, 128) if width == -1 else (128, 255, 128))
+                        color=((128, 128, 255) if width == -1 else (128, 255, 128))
                     )
 
         else:
             _, center, width, coefficient = self.locater.locate_stripped(
                 img)
         if width == -1:
-            if return_image:
-                await websocket.send(json.dumps({"distance":-1, "angle":-1, "center":(-1,-1), "piece_angle":-1, "image_string":jpg_string}))
-            else:
-                await websocket.send(json.dumps({"distance":-1, "angle":-1, "center":(-1,-1), "piece_angle":-1}))
+            data = {"distance":-1, "angle":-1, "center":(-1,-1), "piece_angle":-1}
         else:
             dist, angle_horiz, angle_vert = self.locater.loc_from_center(center)
                     # Calculate the angle of the line in degrees
@@ -806,12 +1292,91 @@ class CameraFunctionalObject:
             new_piece_angle = np.arctan(np.tan(piece_angle)/np.cos(angle_to_piece_vertical))
 
             # print(coefficient, np.degrees(angle_to_piece_vertical)) TODO: is angle horiz correct
-            if return_image:
-                await websocket.send(json.dumps({"distance":dist, "angle":angle_horiz, "center":(center[0], center[1]), "piece_angle":new_piece_angle, "image_string":jpg_string}))
-            else:
-                await websocket.send(json.dumps({"distance":dist, "angle":angle_horiz, "center":(center[0], center[1]), "piece_angle":new_piece_angle}))
-            
-    async def info(self, websocket, *args, **kwargs):
+            data = {"distance":dist, "angle":angle_horiz, "center":(center[0], center[1]), "piece_angle":new_piece_angle}
+
+        if return_image:
+            data["image_string"] = jpg_string
+        await self.send_frame_result(websocket, data, captured, time.monotonic())
+
+    async def time_sync(self, websocket, client_time=None, **kwargs):
+        """
+        Reply with the coprocessor's monotonic clock so the client can estimate the offset between its clock and ours.
+        With t0 the client's send time, t1 our receive time, t2 our send time and t3 the client's receive time, the
+        offset is ((t1 - t0) + (t2 - t3)) / 2 and the round trip delay is (t3 - t0) - (t2 - t1).
+        :param websocket:
+        :param client_time: The client's clock when it sent the request. Echoed back unchanged.
+        :return:
+        """
+        receive_time = time.monotonic()
+        if client_time is not None:
+            client_time = float_we(client_time, "client_time")
+        data = {"client_time": client_time, "server_receive_time": receive_time}
+        await websocket.send(json.dumps(data)[:-1] + f', "server_send_time": {time.monotonic()}}}')
+
+    async def set_detector_options(self, websocket, **kwargs):
+        """
+        Change the options of the AprilTag detector. The C detector is reconfigured in place, so the change applies from
+        the next frame on, and the options are saved for this camera so they are used after a restart as well.
+        :param kwargs: Any of the options in DETECTOR_OPTIONS
+        """
+        self.detector_options = convert_detector_options(kwargs, self.detector_options)
+        # A detection on a worker may be using the options, e.g. the detector only skips copying the frame when it
+        # does not blur it, so wait for it to finish
+        await self.run_in_worker(self.apply_detector_options, self.detector_options)
+
+        save_camera_params(self.serial_number, {"detector_options": self.detector_options})
+
+        await websocket.send(json.dumps({"detector_options": self.detector_options}))
+
+    def apply_detector_options(self, options):
+        """
+        Reconfigure the detector between detections.
+        :param options: Detector options as returned by convert_detector_options.
+        """
+        with self.detector_lock:
+            self.detector.set_options(**options)
+
+    async def set_tag_filter(self, websocket, **kwargs):
+        """
+        Change which AprilTags this camera reports. The filters are saved for this camera, and apriltag can still
+        override them per request.
+        :param kwargs: Any of the filters in TAG_FILTER
+        """
+        self.tag_filter = convert_tag_filter(kwargs, self.tag_filter)
+
+        save_camera_params(self.serial_number, {"tag_filter": self.tag_filter})
+
+        await websocket.send(json.dumps({"tag_filter": self.tag_filter}))
+
+    async def set_field_layout(self, websocket, layout=None, **kwargs):
+        """
+        Replace the field layout used by apriltag's field_pose and save it to .cache/field-layout.json. The layout is
+        shared by all the cameras.
+        :param layout: The layout in WPILib's AprilTag field layout format, as a dictionary or a JSON string.
+        """
+        if layout is None:
+            raise ValueError('Error: set_field_layout needs a "layout".')
+        if isinstance(layout, str):
+            try:
+                layout = json.loads(layout)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'Error: Could not parse parameter "layout" as JSON. {e}') from e
+        field_layout = TagPose.FieldLayout(layout, APRIL_TAG_WIDTH)
+
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        data_path = os.path.join(base_dir, ".cache", "field-layout.json")
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        with open(data_path, 'w') as f:
+            json.dump(layout, f, indent=4)
+        self.field_layout = (os.path.getmtime(data_path), field_layout)
+
+        await websocket.send(json.dumps({"field_layout_tags": field_layout.ids.tolist()}))
+
+    async def info(self, websocket, *args, refresh=False, **kwargs):
+        if (bool_we(refresh, "refresh") or self.camera_properties_generation != self.grabber.generation
+                or not self.camera_properties):
+            self.refresh_camera_properties()
+
         info_dict = {
             "cam_name": self.name,
             "identifier": self.serial_number,
@@ -826,20 +1391,24 @@ class CameraFunctionalObject:
             "vertical_field_of_view_radians": self.vertical_field_of_view,
             "color_list": self.locater.color_list,
             "active_color": self.locater.active_color,
-            "record": self.record
+            "record": self.record,
+            "capture_mode": self.grabber.capture_mode,
+            "camera_mode": self.camera_mode,
+            "detector_options": self.detector_options,
+            "tag_filter": self.tag_filter,
+            "camera_state": self.grabber.state
         }
-
-        for key in cv2_props_dict:
-            try:
-                info_dict[key] = self.camera.get(cv2_props_dict[key])
-            except:
-                pass
+        info_dict.update(self.camera_properties)
 
         await websocket.send(json.dumps(info_dict))
 
     async def function_info(self, websocket, *args, **kwargs):
         info = {"description":"The command will return a lot of information about the current camera setup.",
-                     "arguments": {},
+                     "arguments":
+                         {"refresh":{"type":"bool",
+                                     "description":"Read the camera properties from the camera again instead of using "
+                                     "the cached values. Only needed if something else changed the camera's settings.",
+                                     "optional":True}},
                      "returns":
                         {"cam_name":{"type":"string",
                                      "description":"The name of the camera. This is the path to the camera.",
@@ -918,20 +1487,62 @@ class CameraFunctionalObject:
                                      "guarantee":True},
                         "record":{"type":"bool",
                                   "description":"Whether the camera is currently recording.",
+                                  "guarantee":True},
+                        "capture_mode":{"type":"string",
+                                  "description":"'decoded' if frames are decoded as they are captured, 'mjpeg' if the "
+                                  "camera's JPEG is kept and only decoded when needed, 'gray' if only the luma of "
+                                  "uncompressed frames is kept. Falls back to 'decoded' if the camera does not send the "
+                                  "needed format.",
+                                  "guarantee":True},
+                        "camera_mode":{"type":"dict",
+                                  "description":"The mode the camera was asked for: format, width, height and fps. "
+                                  "Picked at startup as the cheapest mode covering the processing resolution. Null if "
+                                  "the camera's modes are unknown or the frame size was set manually.",
+                                  "guarantee":False},
+                        "detector_options":{"type":"dict",
+                                  "description":"The options of the AprilTag detector, see set_detector_options.",
+                                  "guarantee":True},
+                        "tag_filter":{"type":"dict",
+                                  "description":"This camera's AprilTag filters, see set_tag_filter.",
+                                  "guarantee":True},
+                        "camera_state":{"type":"string",
+                                  "description":"The health of the camera: 'ok', 'reconnecting' if it stopped delivering "
+                                  "frames and is being reopened, or 'lost' if reconnecting has failed several times.",
                                   "guarantee":True}
                         
                      }}
         
+        timing = {"sequence":{"type":"int",
+                              "description":"The sequence number of the frame the result was computed from. Results "
+                              "with the same sequence number come from the same frame.",
+                              "guarantee":True},
+                  "capture_time":{"type":"float",
+                              "description":"Coprocessor monotonic time in seconds at which the frame was captured.",
+                              "guarantee":True},
+                  "processed_time":{"type":"float",
+                              "description":"Coprocessor monotonic time in seconds at which processing finished.",
+                              "guarantee":True},
+                  "send_time":{"type":"float",
+                              "description":"Coprocessor monotonic time in seconds at which the response was sent. "
+                              "Use time_sync to convert these times to the robot's clock.",
+                              "guarantee":True}}
+
         raw = {"description":"The raw command will return a the image as a stringified json image. This command will trigger the server to"
                      "take a picture and send it over the websocket.",
                      "arguments": 
                          {"quality":{"type":"float",
-                                     "description":"Quality of returned image from 0 to 1.",
+                                     "description":"Quality of returned image from 0 to 1. In mjpeg capture mode, leave "
+                                     "this out (with a downscale factor of 1) to get the camera's JPEG without re-encoding.",
+                                     "optional":True},
+                          "passthrough":{"type":"bool",
+                                     "description":"In mjpeg capture mode, always send the camera's JPEG untouched, "
+                                     "ignoring quality and the downscale factor.",
                                      "optional":True}},
                      "returns":
                          {"image_string":{"type":"string",
                                      "description":"JPG image represented as a utf8 encoded string.",
-                                     "guarantee":True}}
+                                     "guarantee":True},
+                          **timing}
                      }
         
         switch_color ={"description":"This command switches the object detection color to the passed index.",
@@ -1009,7 +1620,8 @@ class CameraFunctionalObject:
                                     "guarantee":False},
                         "piece_angle":{"type":"float",
                                     "description":"The angle of the piece in radians.",
-                                    "guarantee":False}}}
+                                    "guarantee":False},
+                        **timing}}
         
         apriltag = {"description":"This command detects AprilTags in the image and returns their positions, orientations, "
                      "distances, and angles.",
@@ -1018,23 +1630,201 @@ class CameraFunctionalObject:
                                      "description":"Whether to return the image with the AprilTags drawn on it.",
                                      "optional":True},
                           "preprocessing_mode":{"type":"string",
-                                     "description":"The preprocessing mode to use. 0 is grayscale, 1 is L1, 2 is L2, 3 is L3. We recommend using 2 or 3.",
+                                     "description":"The preprocessing mode to use. 0 is grayscale, 1 is L1, 2 is L2, 3 is L3. We recommend using 2 or 3. "
+                                     "auto uses the cheapest mode that finds as many tags as the heavier ones and "
+                                     "switches to a heavier mode when detections drop.",
                                      "optional":True},
                           "quality":{"type":"float",
                                      "description":"Quality of returned image from 0 to 1.",
                                      "optional":True},
                           "preprocessor_parameters":{"type":"string",
-                                     "description":"Parameters for the preprocessor in JSON format.",
+                                     "description":"Parameters for the preprocessor in JSON format. Known "
+                                     "parameters are clahe_clip_limit, clahe_tile_size, canny_threshold_1, "
+                                     "canny_threshold_2, edge_refinement_kernel_size, threshold_block_size, "
+                                     "threshold_offset and edge_mask.",
+                                     "optional":True},
+                          "tracking":{"type":"bool",
+                                     "description":"Only search around the tags found on the last frame, which is much "
+                                     "faster. The whole frame is still searched every rescan_interval frames and when a "
+                                     "tag is lost, so new tags can take a few frames to show up.",
+                                     "optional":True},
+                          "rescan_interval":{"type":"int",
+                                     "description":"In tracking mode, search the whole frame at least every this many "
+                                     "frames. Defaults to 10.",
+                                     "optional":True},
+                          "decimation":{"type":"float",
+                                     "description":"Search for tags on the image shrunk by this factor, then refine the "
+                                     "corners on the full image. 2 is several times faster with nearly the same pose "
+                                     "accuracy. Small, distant tags may be missed. Defaults to 1 (no shrinking).",
+                                     "optional":True},
+                          "pyramid":{"type":"bool",
+                                     "description":"Search the frame shrunk 4 times first, and only search at higher "
+                                     "resolution, in the band around the horizon where far tags show up, if no tags or "
+                                     "only small ones were found. Uses tilt_angle_radians to find the horizon. "
+                                     "Replaces decimation for full frame searches.",
+                                     "optional":True},
+                          "min_tag_pixels":{"type":"float",
+                                     "description":"In pyramid mode, tags smaller than this many pixels (at the "
+                                     "resolution they were found at) make the search go on to a higher resolution. "
+                                     "Defaults to 16.",
+                                     "optional":True},
+                          "field_pose":{"type":"bool",
+                                     "description":"Also return the pose of the camera on the field, found with one "
+                                     "solve over the corners of every detected tag in the field layout (see "
+                                     "set_field_layout).",
+                                     "optional":True},
+                          "tag_ids":{"type":"list",
+                                     "description":"Only report these tag IDs. Overrides the camera's tag filter for "
+                                     "this request, like the other filters below.",
+                                     "optional":True},
+                          "tag_family":{"type":"string",
+                                     "description":"Only report tags of this family.",
+                                     "optional":True},
+                          "min_decision_margin":{"type":"float",
+                                     "description":"Drop tags decoded with a smaller decision margin.",
+                                     "optional":True},
+                          "max_hamming":{"type":"int",
+                                     "description":"Drop tags with more corrected bits than this.",
+                                     "optional":True},
+                          "predict":{"type":"bool",
+                                     "description":"Also return where the tags are predicted to be when the response "
+                                     "is sent, from a constant velocity filter per tag ID. Tags lost for less than "
+                                     "0.3 s keep being predicted.",
                                      "optional":True}},
                         "returns":{
                         "image_string":{"type":"string",
                                 "description":"The image with the AprilTags drawn on it. JPG UTF8 string",
                                 "guarantee":False},
+                        "full_scan":{"type":"bool",
+                                "description":"In tracking mode, whether the whole frame was searched for this result.",
+                                "guarantee":False},
+                        "pyramid_level":{"type":"int",
+                                "description":"In pyramid mode, the decimation factor of the finest level that was "
+                                "searched: 4, 2 or 1. Missing if the frame was not searched as a whole (tracking).",
+                                "guarantee":False},
+                        "preprocessing_mode":{"type":"string",
+                                "description":"With preprocessing_mode auto, the mode that was used for this frame.",
+                                "guarantee":False},
                         "tags":{"type":"list",
                                 "description":"A list of dictionaries containing the tag_id, position (3D vector), orientation (3D vector), "
                                 "distance, horizontal angle, and vertical angle.",
-                                "guarantee":False}}}
+                                "guarantee":False},
+                        "field_pose":{"type":"dict",
+                                "description":"With field_pose, the position (3D vector, meters) and orientation (rotation "
+                                "vector, x forward, y left, z up) of the camera on the field, the RMS reprojection_error "
+                                "in pixels and the tag_ids used. Null if no tag of the field layout was seen.",
+                                "guarantee":False},
+                        "predictions":{"type":"list",
+                                "description":"With predict, a dictionary per tag with the tag_id, the position, "
+                                "distance, horizontal_angle and vertical_angle predicted at prediction_time, the "
+                                "velocity of the position, the age of the last measurement and whether the tag was "
+                                "measured on this frame.",
+                                "guarantee":False},
+                        "prediction_time":{"type":"float",
+                                "description":"With predict, the time the predictions are for, just before the send.",
+                                "guarantee":False},
+                        **timing}}
+
+        apriltag_stream = {"description":"Sends the apriltag result for every new frame until stop_stream is called or the "
+                     "connection closes. Converting, detecting and encoding run at the same time on consecutive frames, "
+                     "which gives a much higher rate than calling apriltag in a loop. A stage that is still busy when "
+                     "the next frame arrives drops the older one, so results are never stale. Only one stream runs per "
+                     "connection; starting another replaces it.",
+                     "arguments":apriltag["arguments"],
+                     "returns":{**apriltag["returns"],
+                                "dropped_frames":{"type":"int",
+                                     "description":"Number of frames dropped so far because a stage was busy.",
+                                     "guarantee":True}}}
+
+        stop_stream = {"description":"Stops the stream started by apriltag_stream on this connection.",
+                     "arguments":{},
+                     "returns":
+                         {"streaming":{"type":"bool",
+                                     "description":"Always false.",
+                                     "guarantee":True}}}
+
+        time_sync = {"description":"Returns the coprocessor's clock so the client can estimate the offset between its clock "
+                     "and the coprocessor's, e.g. to compensate for vision latency. With t0 the client's send time, t1 the "
+                     "server receive time, t2 the server send time and t3 the client's receive time, the offset is "
+                     "((t1 - t0) + (t2 - t3)) / 2.",
+                     "arguments":
+                         {"client_time":{"type":"float",
+                                     "description":"The client's clock when the request was sent. It is echoed back.",
+                                     "optional":True}},
+                     "returns":
+                         {"client_time":{"type":"float",
+                                     "description":"The client_time argument, or null if it was not passed.",
+                                     "guarantee":True},
+                          "server_receive_time":{"type":"float",
+                                     "description":"Coprocessor monotonic time in seconds at which the request was received.",
+                                     "guarantee":True},
+                          "server_send_time":{"type":"float",
+                                     "description":"Coprocessor monotonic time in seconds at which the reply was sent.",
+                                     "guarantee":True}}}
         
+        set_detector_options = {"description":"Changes the options of the AprilTag detector. The detector is reconfigured "
+                     "in place and the options are saved for this camera. Options that are not passed keep their value.",
+                     "arguments":
+                         {"nthreads":{"type":"int",
+                                     "description":"Number of threads used for detection. Use the number of cores.",
+                                     "optional":True},
+                          "quad_decimate":{"type":"float",
+                                     "description":"Look for tags on the image shrunk by this factor. Faster, but "
+                                     "small tags are missed. At least 1.",
+                                     "optional":True},
+                          "quad_blur":{"type":"float",
+                                     "description":"Sigma of the Gaussian blur applied before looking for tags. Helps "
+                                     "with noisy images. 0 for no blur.",
+                                     "optional":True},
+                          "refine_edges":{"type":"bool",
+                                     "description":"Snap the tag edges to strong gradients. Slightly slower, more "
+                                     "accurate, especially with quad_decimate.",
+                                     "optional":True},
+                          "refine_decode":{"type":"bool",
+                                     "description":"Spend more time trying to decode tags.",
+                                     "optional":True},
+                          "refine_pose":{"type":"bool",
+                                     "description":"Spend more time trying to precisely localize tags.",
+                                     "optional":True}},
+                     "returns":
+                         {"detector_options":{"type":"dict",
+                                     "description":"All the detector options after the change.",
+                                     "guarantee":True}}}
+
+        set_tag_filter = {"description":"Changes which AprilTags this camera reports. Rejected tags are dropped by the "
+                     "detector, before any pose work. The filters are saved for this camera; apriltag can override them "
+                     "per request. Filters that are not passed keep their value, null turns a filter off.",
+                     "arguments":
+                         {"tag_ids":{"type":"list",
+                                     "description":"Only report these tag IDs. A list or comma separated IDs.",
+                                     "optional":True},
+                          "tag_family":{"type":"string",
+                                     "description":"Only report tags of this family, e.g. tag36h11.",
+                                     "optional":True},
+                          "min_decision_margin":{"type":"float",
+                                     "description":"Drop tags decoded with a smaller decision margin. Low margins are "
+                                     "often false detections.",
+                                     "optional":True},
+                          "max_hamming":{"type":"int",
+                                     "description":"Drop tags with more corrected bits than this.",
+                                     "optional":True}},
+                     "returns":
+                         {"tag_filter":{"type":"dict",
+                                     "description":"All the filters after the change.",
+                                     "guarantee":True}}}
+
+        set_field_layout = {"description":"Replaces the field layout used by apriltag's field_pose and saves it. The "
+                     "layout is shared by all the cameras.",
+                     "arguments":
+                         {"layout":{"type":"dict",
+                                     "description":"The tag poses in WPILib's AprilTag field layout format (the JSON "
+                                     "files WPILib ships for every season), in meters.",
+                                     "optional":False}},
+                     "returns":
+                         {"field_layout_tags":{"type":"list",
+                                     "description":"The IDs of the tags in the new layout.",
+                                     "guarantee":True}}}
+
         set_camera_params = {"description":"Use this to change the values used by the camera capture.",
                      "arguments": 
                          {"horizontal_focal_length":{"type":"float",
@@ -1090,6 +1880,14 @@ class CameraFunctionalObject:
                                   "description":"Whether the camera is currently recording. This is used to save the video stream to a file",
                                   "optional":True},
 
+                        "capture_mode":{"type":"string",
+                                  "description":"'decoded' to decode every frame as it is captured, 'mjpeg' to keep the "
+                                  "camera's JPEG and only decode it when a command needs the pixels, or 'gray' to capture "
+                                  "uncompressed YUYV and keep only the luma. mjpeg makes raw nearly free but only works "
+                                  "with cameras that send MJPG. gray is the cheapest for AprilTag-only cameras, but piece "
+                                  "detection does not work in it.",
+                                  "optional":True},
+
                         "aperture":{"type":"float",
                                      "description":"The aperture of the camera. This is the size of the opening in the lens that lets light in.",
                                      "optional":True},
@@ -1210,14 +2008,20 @@ class CameraFunctionalObject:
             "set_camera_params": set_camera_params,
             "piece": piece,
             "apriltag": apriltag,
+            "apriltag_stream": apriltag_stream,
+            "stop_stream": stop_stream,
+            "time_sync": time_sync,
+            "set_detector_options": set_detector_options,
+            "set_field_layout": set_field_layout,
+            "set_tag_filter": set_tag_filter,
             "info": info,
         }))
 
     def __del__(self):
         # Cleanup code
 
-        if hasattr(self, 'camera') and self.camera.isOpened():
-            self.camera.release()
+        if hasattr(self, 'grabber'):
+            self.grabber.release()
         if hasattr(self, 'video_writer') and self.video_writer is not None:
             print("Releasing video writer.")
             self.video_writer.release()
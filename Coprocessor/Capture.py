@@ -0,0 +1,401 @@
+import threading
+import time
+import cv2
+import numpy as np
+from Backends import open_backend
+from constants import (CAMERA_RECONNECT_INITIAL_DELAY, CAMERA_RECONNECT_MAX_DELAY, CAMERA_LOST_AFTER_ATTEMPTS,
+                       CAMERA_FRAME_WAIT_TIMEOUT)
+
+"""
+This file contains the FrameGrabber class which continuously reads frames from a camera in its own thread and keeps
+only the newest one. The command handlers in CameraFunctional ask the grabber for the latest frame instead of reading
+from the camera themselves, so a slow camera never blocks the websocket event loop and handlers never receive a stale
+frame that was sitting in the driver's buffer. Every frame carries a sequence number and the monotonic time at which it
+was captured.
+
+If the camera stops delivering frames the grabber reconnects it from the capture thread with exponential backoff. The
+health of the camera is exposed as one of the states below so that command handlers can fail fast with a useful error
+instead of waiting for the camera to come back.
+
+The grabber does not talk to OpenCV directly but to a capture backend (see Backends.py), so it can read from a camera, a
+replayed recording or a synthetic scene in the same way.
+"""
+
+CAMERA_OK = "ok"
+CAMERA_RECONNECTING = "reconnecting"
+CAMERA_LOST = "lost"
+
+# Capture modes. In "decoded" mode OpenCV decodes every frame as it is read. In "mjpeg" mode the compressed JPEG the
+# camera sends is kept as is and only decoded if a command actually needs the pixels, so it can be forwarded untouched.
+# In "gray" mode the camera is asked for uncompressed YUYV (or GREY) and only the luma plane is kept. That is all
+# AprilTag detection needs, so there is no decoding or color conversion at all, but color commands don't work.
+CAPTURE_DECODED = "decoded"
+CAPTURE_MJPEG = "mjpeg"
+CAPTURE_GRAY = "gray"
+CAPTURE_MODES = (CAPTURE_DECODED, CAPTURE_MJPEG, CAPTURE_GRAY)
+# Camera formats suited to each capture mode, best first
+CAPTURE_FORMATS = {
+    CAPTURE_DECODED: ("MJPG", "YUYV"),
+    CAPTURE_MJPEG: ("MJPG",),
+    CAPTURE_GRAY: ("YUYV", "GREY"),
+}
+
+
+# Color spaces a frame can be requested in. Frames are captured in BGR, which is what OpenCV uses natively.
+COLOR_BGR = "BGR"
+COLOR_RGB = "RGB"
+COLOR_GRAY = "GRAY"
+
+_COLOR_CONVERSIONS = {
+    (COLOR_BGR, COLOR_RGB): cv2.COLOR_BGR2RGB,
+    (COLOR_BGR, COLOR_GRAY): cv2.COLOR_BGR2GRAY,
+    (COLOR_RGB, COLOR_BGR): cv2.COLOR_RGB2BGR,
+    (COLOR_RGB, COLOR_GRAY): cv2.COLOR_RGB2GRAY,
+    (COLOR_GRAY, COLOR_BGR): cv2.COLOR_GRAY2BGR,
+    (COLOR_GRAY, COLOR_RGB): cv2.COLOR_GRAY2RGB,
+}
+
+
+def convert_color(image, source, target):
+    """
+    Convert an image between color spaces, doing nothing if it is already in the target color space.
+    :param image: ndarray
+    :param source: The color space the image is in.
+    :param target: The color space wanted.
+    :return: ndarray in the target color space. This is the same array as image if no conversion was needed.
+    """
+    if source == target:
+        return image
+    return cv2.cvtColor(image, _COLOR_CONVERSIONS[(source, target)])
+
+
+def luma_plane(buffer, size=None):
+    """
+    Get the Y (luma) plane out of an uncompressed YUYV or GREY buffer without copying it.
+    :param buffer: ndarray returned by cv2.VideoCapture.retrieve with RGB conversion turned off. Either (h, w, 2) or flat.
+    :param size: (height, width) of the frame, needed if the buffer is flat.
+    :return: (h, w) ndarray view of the luma, or None if the buffer is not in a known format.
+    """
+    if buffer.ndim == 3 and buffer.shape[2] == 2:
+        return buffer[:, :, 0]
+    if size is None:
+        return None
+    height, width = size
+    if buffer.size == height * width * 2:
+        # YUYV: Y0 U0 Y1 V0 ..., every other byte is luma
+        return buffer.reshape(height, width, 2)[:, :, 0]
+    if buffer.size == height * width:
+        # GREY is nothing but luma
+        return buffer.reshape(height, width)
+    return None
+
+
+def is_jpeg(buffer):
+    """
+    Check whether a buffer returned by the camera holds a compressed JPEG image rather than decoded pixels.
+    :param buffer: ndarray returned by cv2.VideoCapture.retrieve
+    :return: bool
+    """
+    return (buffer is not None and buffer.dtype == np.uint8 and (buffer.ndim == 1 or buffer.shape[0] == 1)
+            and buffer.size > 2 and buffer.flat[0] == 0xFF and buffer.flat[1] == 0xD8)
+
+
+class Frame:
+    """
+    A single captured frame. The sequence number increases by one for every frame the grabber reads, so two frames with
+    the same sequence number are the same image. The timestamp is taken from time.monotonic() as soon as the camera
+    hands the frame over. If the frame was captured in mjpeg mode, jpeg holds the bytes the camera sent and the image is
+    decoded the first time it is accessed.
+
+    The frame knows which color space its image is in. Use get() to ask for a specific color space; each conversion is
+    done at most once per frame no matter how many stages need it. Images returned by get() are shared, so copy them
+    before drawing on them.
+    """
+    __slots__ = ("_image", "jpeg", "sequence", "timestamp", "color_space", "_converted")
+
+    def __init__(self, image, sequence, timestamp, jpeg=None, color_space=COLOR_BGR):
+        self._image = image
+        self.jpeg = jpeg
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.color_space = color_space
+        self._converted = {}
+
+    @property
+    def image(self):
+        if self._image is None and self.jpeg is not None:
+            self._image = cv2.imdecode(self.jpeg, cv2.IMREAD_COLOR)
+        return self._image
+
+    def get(self, color_space):
+        """
+        Get the image in the given color space, converting it on first use.
+        :param color_space: COLOR_BGR, COLOR_RGB or COLOR_GRAY
+        :return: ndarray
+        """
+        if color_space == self.color_space:
+            return self.image
+        converted = self._converted.get(color_space)
+        if converted is None:
+            if color_space == COLOR_GRAY and self._image is None and self.jpeg is not None:
+                # Only the luma needs decoding, which is cheaper than decoding the color image and converting it.
+                converted = cv2.imdecode(self.jpeg, cv2.IMREAD_GRAYSCALE)
+            else:
+                converted = convert_color(self.image, self.color_space, color_space)
+            self._converted[color_space] = converted
+        return converted
+
+
+class FrameGrabber:
+    """
+    This class owns a capture backend and reads from it in a background thread. Only the most recent frame is kept. All
+    other access to the camera (get and set) goes through the grabber so it is serialized with the reads. Properties
+    that are set are remembered and applied again whenever the camera is reopened.
+    """
+    def __init__(self, name, camera=None, capture_mode=CAPTURE_DECODED):
+        self.name = name
+        self.camera = camera if camera is not None else open_backend(name)
+        self.capture_mode = capture_mode
+        self.camera_lock = threading.Lock()
+        self.frame_condition = threading.Condition()
+        self.latest = None
+        self.sequence = 0
+        self.running = False
+        self.thread = None
+        # Set by release, the capture thread then closes the camera when it finishes
+        self.release_on_exit = False
+
+        self.properties = {}
+        self.generation = 0  # Incremented every time the camera is reopened, so cached camera state can be refreshed
+        self.state = CAMERA_OK
+        self.reconnect_attempts = 0
+        self.next_attempt_time = None
+
+    def start(self):
+        """
+        Start the capture thread. This must be called from the process that serves the requests, since threads are not
+        carried over when the server process is forked.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"capture-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the capture thread.
+        :return: False if the thread has not finished after 2 seconds, e.g. because it is stuck in the camera.
+        """
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+            if self.thread.is_alive():
+                return False
+        self.thread = None
+        return True
+
+    def read_once(self):
+        """
+        Read a single frame synchronously. Only used before the capture thread is started, e.g. to check that the
+        camera works at startup.
+        :return: (bool, ndarray) like cv2.VideoCapture.read
+        """
+        with self.camera_lock:
+            return self.camera.read()
+
+    def _run(self):
+        try:
+            self._capture()
+        finally:
+            if self.release_on_exit:
+                self._close_camera()
+
+    def _capture(self):
+        while self.running:
+            if self.state != CAMERA_OK:
+                self._reconnect()
+                continue
+
+            # Wait for the frame before taking the lock, so get and set don't have to wait for it as well
+            if not self.camera.wait(CAMERA_FRAME_WAIT_TIMEOUT):
+                continue
+            image = None
+            with self.camera_lock:
+                ret = self.camera.grab()
+                timestamp = time.monotonic()
+                if ret:
+                    ret, image = self.camera.retrieve()
+                if ret and self.capture_mode == CAPTURE_GRAY and image is not None and image.ndim < 3:
+                    # Some backends hand raw buffers over flat, we need the frame size to find the planes
+                    size = (int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                            int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+            if (not ret or image is None) and getattr(self.camera, "finished", False):
+                # A recording that doesn't loop has ended, there is nothing to reconnect to.
+                print(f"Replay of {self.name} finished.")
+                with self.frame_condition:
+                    self.latest = None
+                self.state = CAMERA_LOST
+                self.running = False
+                return
+
+            if not ret or image is None:
+                # The camera did not deliver a frame. Hand over to the reconnect logic, the latest frame is dropped
+                # so that nobody processes it as if it were current.
+                print(f"Camera {self.name} stopped delivering frames. Reconnecting.")
+                with self.frame_condition:
+                    self.latest = None
+                self.state = CAMERA_RECONNECTING
+                self.reconnect_attempts = 0
+                self.next_attempt_time = time.monotonic() + CAMERA_RECONNECT_INITIAL_DELAY
+                continue
+
+            if self.capture_mode in (CAPTURE_MJPEG, CAPTURE_GRAY) and is_jpeg(image):
+                # In gray mode this happens with cameras that only send MJPG. Frame.get(COLOR_GRAY) still only decodes
+                # the luma.
+                frame = Frame(None, self.sequence + 1, timestamp, jpeg=image.reshape(-1))
+            elif self.capture_mode == CAPTURE_GRAY and (image.ndim < 3 or image.shape[2] == 2):
+                luma = luma_plane(image, size if image.ndim < 3 else None)
+                if luma is None:
+                    print(f"Camera {self.name} does not send YUYV or GREY frames. Falling back to decoded capture.")
+                    self.set_capture_mode(CAPTURE_DECODED)
+                    continue
+                frame = Frame(luma, self.sequence + 1, timestamp, color_space=COLOR_GRAY)
+            elif self.capture_mode == CAPTURE_MJPEG and (image.ndim != 3 or image.shape[2] != 3):
+                # The camera sent some other raw format, so we can't use mjpeg mode with it.
+                print(f"Camera {self.name} does not send MJPG frames. Falling back to decoded capture.")
+                self.set_capture_mode(CAPTURE_DECODED)
+                continue
+            else:
+                # Either decoded mode, or the source ignored the request for the compressed stream.
+                frame = Frame(image, self.sequence + 1, timestamp)
+
+            with self.frame_condition:
+                self.sequence += 1
+                self.latest = frame
+                self.frame_condition.notify_all()
+
+    def _reconnect(self):
+        """
+        Make one attempt to reopen the camera, waiting for the backoff delay first. Runs on the capture thread.
+        """
+        delay = self.next_attempt_time - time.monotonic()
+        if delay > 0:
+            time.sleep(min(delay, 0.1))
+            return
+
+        with self.camera_lock:
+            self.camera.release()
+
+        # Open the new capture outside the lock, this can take a while and get/set should not wait for it.
+        camera = open_backend(self.name)
+        works = camera.isOpened()
+        if works:
+            for prop, value in self.properties.items():
+                camera.set(prop, value)
+            works = camera.grab()
+
+        if works:
+            with self.camera_lock:
+                self.camera = camera
+            self.generation += 1
+            self.state = CAMERA_OK
+            self.reconnect_attempts = 0
+            self.next_attempt_time = None
+            print(f"Camera {self.name} reconnected.")
+            return
+
+        camera.release()
+        self.reconnect_attempts += 1
+        if self.reconnect_attempts >= CAMERA_LOST_AFTER_ATTEMPTS:
+            self.state = CAMERA_LOST
+        delay = min(CAMERA_RECONNECT_INITIAL_DELAY * 2 ** self.reconnect_attempts, CAMERA_RECONNECT_MAX_DELAY)
+        self.next_attempt_time = time.monotonic() + delay
+
+    def set_capture_mode(self, capture_mode):
+        """
+        Switch between decoded, mjpeg and gray capture. In mjpeg and gray mode OpenCV is asked not to convert the frames,
+        which makes the V4L2 backend return the camera's buffer as is. Gray mode also asks the camera for YUYV instead of
+        MJPG.
+        :param capture_mode: One of CAPTURE_MODES
+        """
+        if capture_mode not in CAPTURE_MODES:
+            raise ValueError(f'Error: Unknown capture mode "{capture_mode}". Use one of {", ".join(CAPTURE_MODES)}.')
+        self.capture_mode = capture_mode
+        self.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*('YUYV' if capture_mode == CAPTURE_GRAY else 'MJPG')))
+        self.set(cv2.CAP_PROP_CONVERT_RGB, 1 if capture_mode == CAPTURE_DECODED else 0)
+
+    def health(self):
+        """
+        :return: A dictionary describing the state of the camera, suitable for sending to the client.
+        """
+        health = {"camera_state": self.state}
+        if self.state != CAMERA_OK:
+            health["reconnect_attempts"] = self.reconnect_attempts
+            if self.next_attempt_time is not None:
+                health["retry_in"] = max(self.next_attempt_time - time.monotonic(), 0)
+        return health
+
+    def latest_frame(self):
+        """
+        :return: The newest Frame, or None if no frame has been captured yet or the camera is not working.
+        """
+        if self.state != CAMERA_OK:
+            return None
+        return self.latest
+
+    def wait_for_frame(self, after_sequence=0, timeout=None):
+        """
+        Block until a frame newer than after_sequence is available.
+        :param after_sequence: The sequence number of the last frame the caller has seen.
+        :param timeout: Maximum number of seconds to wait.
+        :return: The newest Frame, or None if the timeout expired.
+        """
+        with self.frame_condition:
+            self.frame_condition.wait_for(lambda: self.latest is not None and self.latest.sequence > after_sequence,
+                                          timeout=timeout)
+            if self.latest is None or self.latest.sequence <= after_sequence:
+                return None
+            return self.latest
+
+    def set(self, prop, value):
+        self.properties[prop] = value
+        if self.state != CAMERA_OK:
+            # Applied when the camera is reopened.
+            return False
+        with self.camera_lock:
+            return self.camera.set(prop, value)
+
+    def get(self, prop):
+        if self.state != CAMERA_OK:
+            return None
+        with self.camera_lock:
+            return self.camera.get(prop)
+
+    def list_modes(self):
+        """
+        :return: The modes the camera supports, see CaptureBackend.list_modes. Empty if the camera is not working.
+        """
+        if self.state != CAMERA_OK or not hasattr(self.camera, "list_modes"):
+            return []
+        with self.camera_lock:
+            return self.camera.list_modes()
+
+    def is_opened(self):
+        with self.camera_lock:
+            return self.camera.isOpened()
+
+    def release(self):
+        """
+        Stop the capture thread and close the camera. If the thread is stuck in the camera, waiting for the lock here
+        could hang forever, so the thread is left to close the camera itself when it gets out.
+        """
+        self.release_on_exit = True
+        if self.stop():
+            self._close_camera()
+
+    def _close_camera(self):
+        with self.camera_lock:
+            if self.camera.isOpened():
+                self.camera.release()
@@ -1,9 +1,34 @@
 import cv2
 import numpy as np
 import json
+from functools import lru_cache
 from constants import (CAMERA_HORIZONTAL_RESOLUTION_PIXELS, CAMERA_VERTICAL_RESOLUTION_PIXELS, TILT_ANGLE_RADIANS,
                        CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS, CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS, CAMERA_HEIGHT,
-                       DOWNSCALE_FACTOR)
+                       DOWNSCALE_FACTOR, PIECE_PRESENCE_STEP)
+
+
+@lru_cache(maxsize=16)
+def color_distance_table(blue, green, red):
+    """
+    Build the lookup table giving, for every value of every channel, its distance to the target color in that channel.
+    The distance in a single channel is at most 255, so the table is 8 bit. Built once per color and cached.
+    :return: Table for cv2.LUT, of shape (1, 256, 3)
+    """
+    values = np.arange(256)[:, None]
+    return np.abs(values - np.array([blue, green, red])).astype(np.uint8).reshape(1, 256, 3)
+
+
+def color_distance(image, table):
+    """
+    The distance of every pixel of a BGR image to a target color: the sum of the distances in each channel, i.e. three
+    times the average used to compare colors. Computed with lookup tables and summed in 16 bits, so the frame is never
+    promoted to a wider type.
+    :param table: Table from color_distance_table.
+    :return: uint16 array of the image's height and width.
+    """
+    blue, green, red = cv2.split(cv2.LUT(image, table))
+    distance = cv2.add(blue, green, dtype=cv2.CV_16U)
+    return cv2.add(distance, red, dtype=cv2.CV_16U)
 
 
 class Locater:
@@ -62,14 +87,36 @@ class Locater:
         self.max_vertical_angle = self.camera_vertical_resolution_pixels * self.res_corresp_vertical
         self.max_horizontal_angle = self.camera_horizontal_resolution_pixels * self.res_corresp_horizontal
 
+    def find_seed(self, image, dif):
+        """
+        Find the pixel closest to the target color, from which the object is flood filled.
+        :param image: Numpy array of the image in BGR order
+        :param dif: Maximum average difference per channel for a pixel to match. The closest pixel has to be within
+        twice this.
+        :return: (row, column) of the closest pixel, or None if no pixel is close enough
+        """
+        color = self.color_list[self.active_color]
+        table = color_distance_table(int(color["blue"]), int(color["green"]), int(color["red"]))
+        # Distances are summed over the channels instead of averaged
+        limit = dif * 2 * 3
+
+        # Most frames don't contain the color at all, so check every few pixels first and stop there if nothing is
+        # close
+        if color_distance(image[::PIECE_PRESENCE_STEP, ::PIECE_PRESENCE_STEP], table).min() > limit:
+            return None
+
+        distance = color_distance(image, table)
+        return np.unravel_index(np.argmin(distance), distance.shape)
+
     def locate(self, image, blur=-1, dif=-1):
         """
         This function locates the object in the image. It uses the target color and the parameters to find the object.
         :param blur:
         :param dif:
-        :param image: Numpy array of the image
-        :return: (ndarray, tuple, int) where the first is the processed image with crosshairs etc.,
-        center is the center of the object (x, y), and width is the width of the object
+        :param image: Numpy array of the image in BGR order, as captured by OpenCV
+        :return: (ndarray, tuple, int, float) where the first is the processed image with crosshairs etc.,
+        center is the center of the object (x, y), width is the width of the object and the last is the slope of the
+        object. If no pixel matches the color, center is (-1, -1) and width is -1.
         """
         if blur == -1:
             blur = self.color_list[self.active_color]["blur"]
@@ -81,14 +128,11 @@ class Locater:
         new_color = [-0.666, -0.666, -0.666]
         image_copy = image.copy()
 
-        # Normalize the image and target color
-        array = np.average(np.abs(image - np.array([self.color_list[self.active_color]["red"],
-                                                    self.color_list[self.active_color]["green"],
-                                                    self.color_list[self.active_color]["blue"]])), 2)
-        if np.all(array > dif*2):
+        seed = self.find_seed(image, dif)
+        if seed is None:
             # print("No matching color found")
-            return image, (-1, -1), -1
-        x, y = np.unravel_index(np.argmin(array), array.shape)
+            return image, (-1, -1), -1, 0
+        x, y = seed
 
         if blur > 0:
             """image = cv2.blur(image, (blur, blur))
@@ -158,9 +202,10 @@ class Locater:
         This function locates the object in the image. It uses the target color and the parameters to find the object.
         :param blur:
         :param dif:
-        :param image: Numpy array of the image
-        :return: (ndarray, tuple, int) where the first is the processed image with crosshairs etc.,
-        center is the center of the object (x, y), and width is the width of the object
+        :param image: Numpy array of the image in BGR order, as captured by OpenCV
+        :return: (ndarray, tuple, int, float) where the first is the processed image with crosshairs etc.,
+        center is the center of the object (x, y), width is the width of the object and the last is the slope of the
+        object. If no pixel matches the color, center is (-1, -1) and width is -1.
         """
         if blur == -1:
             blur = self.color_list[self.active_color]["blur"]
@@ -171,13 +216,10 @@ class Locater:
         # Convert the image and target color to the Lab color space
         new_color = [-1, -1, -1]
 
-        # Normalize the image and target color
-        array = np.average(np.abs(image - np.array([self.color_list[self.active_color]["red"],
-                                                    self.color_list[self.active_color]["green"],
-                                                    self.color_list[self.active_color]["blue"]])), 2)
-        if np.all(array > dif*2):
-            return image, (-1, -1), -1
-        x, y = np.unravel_index(np.argmin(array), array.shape)
+        seed = self.find_seed(image, dif)
+        if seed is None:
+            return image, (-1, -1), -1, 0
+        x, y = seed
 
         if blur > 0:
             image = cv2.bilateralFilter(image, int(blur), int(blur)*2, int(blur)//2)
@@ -0,0 +1,128 @@
+import threading
+import numpy as np
+from constants import (MOTION_FILTER_POSITION_NOISE, MOTION_FILTER_ANGLE_NOISE, MOTION_FILTER_POSITION_ACCELERATION,
+                       MOTION_FILTER_ANGLE_ACCELERATION, MOTION_FILTER_DROPOUT)
+
+"""
+This file contains the per-tag motion filter used by apriltag's predict. Every tag ID gets a constant velocity Kalman
+filter over its position, distance and angles, updated with each frame's measurements at the frame's capture time. The
+filter can then extrapolate where the tags are at any later time, which makes up for the latency between capture and
+send and keeps a tag reported for a short while after it stops being detected.
+
+Every value is filtered on its own, with a state of the value and its rate of change, so the filters of all the values of
+a tag run together as arrays.
+"""
+
+# The values filtered for each tag, in the order of the state arrays: the keys of the tag dictionaries from
+# CameraFunctionalObject.tag_poses, with position split into its three coordinates
+FILTERED_VALUES = ("x", "y", "z", "distance", "horizontal_angle", "vertical_angle")
+MEASUREMENT_NOISE = np.array([MOTION_FILTER_POSITION_NOISE] * 4 + [MOTION_FILTER_ANGLE_NOISE] * 2) ** 2
+ACCELERATION_NOISE = np.array([MOTION_FILTER_POSITION_ACCELERATION] * 4 + [MOTION_FILTER_ANGLE_ACCELERATION] * 2) ** 2
+# Variance of the rate of change of a tag that was just seen for the first time
+INITIAL_RATE_VARIANCE = np.array([2.0] * 4 + [1.0] * 2) ** 2
+
+
+def measurement_values(tag):
+    """
+    :param tag: Dictionary as returned by CameraFunctionalObject.tag_poses.
+    :return: The filtered values of the tag, in the order of FILTERED_VALUES.
+    """
+    return np.array(tag["position"] + [tag["distance"], tag["horizontal_angle"], tag["vertical_angle"]])
+
+
+def predict_state(state, covariance, dt):
+    """
+    Move constant velocity states forward in time.
+    :param state: (n, 2) values and their rates of change.
+    :param covariance: (n, 2, 2) covariances of the states.
+    :param dt: Seconds to move forward.
+    :return: The predicted (state, covariance).
+    """
+    state = np.stack([state[:, 0] + dt * state[:, 1], state[:, 1]], axis=1)
+    transition = np.array([[1, dt], [0, 1]])
+    # Noise of a constant acceleration during dt
+    process_noise = np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+    covariance = transition @ covariance @ transition.T + ACCELERATION_NOISE[:, None, None] * process_noise
+    return state, covariance
+
+
+class TagTrack:
+    """
+    The filter of one tag.
+    """
+    def __init__(self, values, time):
+        self.time = time
+        self.state = np.stack([values, np.zeros_like(values)], axis=1)
+        self.covariance = np.zeros((len(values), 2, 2))
+        self.covariance[:, 0, 0] = MEASUREMENT_NOISE
+        self.covariance[:, 1, 1] = INITIAL_RATE_VARIANCE
+
+    def update(self, values, time):
+        """
+        Move the filter to the time of a measurement and correct it with the measurement.
+        """
+        state, covariance = predict_state(self.state, self.covariance, time - self.time)
+        # Only the value is measured, not its rate of change
+        gain = covariance[:, :, 0] / (covariance[:, 0, 0] + MEASUREMENT_NOISE)[:, None]
+        self.state = state + gain * (values - state[:, 0])[:, None]
+        self.covariance = covariance - gain[:, :, None] * covariance[:, None, 0, :]
+        self.time = time
+
+
+class TagMotionFilter:
+    """
+    Constant velocity filters for every tag ID seen in the last MOTION_FILTER_DROPOUT seconds. Updates and predictions
+    can come from several worker threads.
+    """
+    def __init__(self, dropout=MOTION_FILTER_DROPOUT):
+        self.dropout = dropout
+        self.tracks = {}
+        self.last_sequence = None
+        self.lock = threading.Lock()
+
+    def update(self, tags, capture_time, sequence):
+        """
+        Add the measurements of a frame. Frames older than the last one added, or added already, are ignored, so
+        results coming back from the workers out of order or the same frame processed twice don't confuse the filter.
+        :param tags: List of dictionaries as returned by CameraFunctionalObject.tag_poses.
+        :param capture_time: When the frame was captured, from time.monotonic().
+        :param sequence: The sequence number of the frame.
+        """
+        with self.lock:
+            if self.last_sequence is not None and sequence <= self.last_sequence:
+                return
+            self.last_sequence = sequence
+
+            for tag in tags:
+                values = measurement_values(tag)
+                track = self.tracks.get(tag["tag_id"])
+                if track is None or capture_time - track.time > self.dropout:
+                    self.tracks[tag["tag_id"]] = TagTrack(values, capture_time)
+                else:
+                    track.update(values, capture_time)
+
+            self.tracks = {tag_id: track for tag_id, track in self.tracks.items()
+                           if capture_time - track.time <= self.dropout}
+
+    def predict(self, time, measured_ids=()):
+        """
+        Extrapolate every tag seen in the last MOTION_FILTER_DROPOUT seconds to a time.
+        :param time: The time to predict at, from time.monotonic().
+        :param measured_ids: IDs of the tags that were detected on the frame the response is for.
+        :return: List of dictionaries with the tag_id, the predicted position, distance, horizontal_angle,
+        vertical_angle and velocity (of the position), the age of the last measurement in seconds, and measured, False
+        for tags that were not detected on the frame and are only predicted.
+        """
+        predictions = []
+        with self.lock:
+            for tag_id, track in self.tracks.items():
+                age = time - track.time
+                if age > self.dropout:
+                    continue
+                # The rates of change stay the same, only the values move
+                values = (track.state[:, 0] + age * track.state[:, 1]).tolist()
+                predictions.append({"tag_id": tag_id, "position": values[:3], "distance": values[3],
+                                    "horizontal_angle": values[4], "vertical_angle": values[5],
+                                    "velocity": track.state[:3, 1].tolist(), "age": age,
+                                    "measured": tag_id in measured_ids})
+        return predictions
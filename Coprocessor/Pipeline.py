@@ -0,0 +1,136 @@
+import threading
+from collections import deque
+from constants import PIPELINE_QUEUE_SIZE
+
+"""
+This file contains the staged pipeline used to stream results. Every stage runs in its own thread and hands its output
+to the next stage through a bounded queue, so while one frame is in detection the next one is already being converted
+and the previous one is being encoded and sent. When a queue is full the oldest item in it is dropped: a stage that
+can't keep up always works on the newest frame instead of falling further and further behind.
+"""
+
+
+class DropOldestQueue:
+    """
+    A thread safe queue that drops its oldest item instead of blocking when it is full.
+    """
+    def __init__(self, maxsize=PIPELINE_QUEUE_SIZE):
+        self.maxsize = max(maxsize, 1)
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for an item.
+        :return: The oldest item, or None if the queue was closed or the timeout expired.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.items or self.closed, timeout=timeout)
+            if self.closed or not self.items:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.items.clear()
+            self.condition.notify_all()
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages, each in its own thread, connected by DropOldestQueues.
+    """
+    def __init__(self, source, stages, sink, queue_size=PIPELINE_QUEUE_SIZE, name="pipeline"):
+        """
+        :param source: Function producing the next item, called over and over by the first thread. It should block
+        until an item is available (with a timeout, so the pipeline can stop) and return None if there is none.
+        :param stages: List of functions, each turning an item into the item for the next stage. A stage can return None
+        to drop the item.
+        :param sink: Function called with every item that comes out of the last stage, in the last stage's thread.
+        :param queue_size: Size of the queue in front of each stage.
+        """
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+        self.name = name
+        self.queues = [DropOldestQueue(queue_size) for _ in self.stages]
+        self.running = False
+        self.threads = []
+        # The first exception raised by a stage. It stops the pipeline.
+        self.error = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.threads = [threading.Thread(target=self._run_source, name=f"{self.name}-source", daemon=True)]
+        for index in range(len(self.stages)):
+            self.threads.append(threading.Thread(target=self._run_stage, args=(index,),
+                                                 name=f"{self.name}-stage-{index}", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for queue in self.queues:
+            queue.close()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=2)
+        self.threads = []
+
+    @property
+    def dropped(self):
+        """
+        :return: Number of items dropped so far because a stage was busy.
+        """
+        return sum(queue.dropped for queue in self.queues)
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.running = False
+        for queue in self.queues:
+            queue.close()
+
+    def _run_source(self):
+        try:
+            while self.running:
+                item = self.source()
+                if item is None:
+                    continue
+                if self.queues:
+                    self.queues[0].put(item)
+                else:
+                    self.sink(item)
+        except Exception as e:
+            self._fail(e)
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        queue = self.queues[index]
+        try:
+            while self.running:
+                item = queue.get(timeout=0.5)
+                if item is None:
+                    continue
+                item = stage(item)
+                if item is None:
+                    continue
+                if index + 1 < len(self.queues):
+                    self.queues[index + 1].put(item)
+                else:
+                    self.sink(item)
+        except Exception as e:
+            self._fail(e)
@@ -0,0 +1,311 @@
+import json
+import time
+from collections import deque
+from functools import lru_cache
+import cv2
+import numpy as np
+from constants import (AUTO_PREPROCESS_WINDOW, AUTO_PREPROCESS_PROBE_INTERVAL, AUTO_PREPROCESS_RECENT_FRAMES,
+                       AUTO_PREPROCESS_KEEP_FRACTION)
+
+"""
+This file contains the preprocessing pipelines that can be run on a grayscale image before AprilTag detection. A
+pipeline is built once for a preprocessing mode and set of parameters and then reused for every frame: the CLAHE object
+and kernels are created up front, and every stage writes into buffers that are kept from one frame to the next instead
+of allocating new images. Use get_preprocessor to get the pipeline for a request; pipelines are cached, so asking for the
+same mode and parameters again is free.
+
+The modes are:
+* 1 (L1): adaptive threshold.
+* 2 (L2): adaptive threshold, optionally masked to the neighborhood of the Canny edges.
+* 3 (L3): like L2, but the contrast is evened out with CLAHE before thresholding.
+
+With the mode "auto" a PreprocessSelector picks the mode for every frame from how well and how fast each mode has
+done recently.
+
+The image returned by a pipeline belongs to it and is overwritten by the next call. The detector reads it in place
+rather than copying it (unless quad_blur is set), so don't preprocess another image with the same pipeline while a
+detection on the previous one is still running.
+"""
+
+# Parameters that can be passed in preprocessor_parameters, with their defaults
+DEFAULT_PREPROCESSOR_PARAMETERS = {
+    "clahe_clip_limit": 3.0,
+    "clahe_tile_size": 8,
+    "canny_threshold_1": 50,
+    "canny_threshold_2": 150,
+    "edge_refinement_kernel_size": 3,
+    "threshold_block_size": 35,
+    "threshold_offset": 3,
+    "edge_mask": False,
+}
+
+# The preprocessing modes, from what should be the cheapest to the most expensive. The automatic selection reorders
+# them by their measured time.
+PREPROCESSING_MODES = ("0", "1", "2", "3")
+AUTO_MODE = "auto"
+
+# How many differently sized sets of buffers a pipeline keeps. Tracking searches crops of changing size, so this is
+# bounded.
+MAX_BUFFER_SHAPES = 8
+
+
+def _convert_parameter(name, value):
+    """
+    Convert a preprocessor parameter to the type of its default, with the same kind of error message as the other
+    parameters.
+    """
+    expected_type = type(DEFAULT_PREPROCESSOR_PARAMETERS[name])
+    try:
+        if expected_type is bool:
+            if isinstance(value, str) and value.lower() in ['true', 'false', '1', '0']:
+                return value.lower() in ['true', '1']
+            return bool(value)
+        return expected_type(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Error: Could not convert preprocessor parameter "{name}" with value "{value}" to '
+                         f'{"an integer" if expected_type is int else "a float"}.') from e
+
+
+class PreprocessPipeline:
+    """
+    A preprocessing pipeline for one mode and set of parameters. Call it with a grayscale image to preprocess it.
+    """
+    def __init__(self, mode, parameters=None):
+        """
+        :param mode: "1", "2" or "3"
+        :param parameters: Dictionary of parameters, see DEFAULT_PREPROCESSOR_PARAMETERS. Unknown ones are ignored.
+        """
+        self.mode = mode
+        self.parameters = dict(DEFAULT_PREPROCESSOR_PARAMETERS)
+        for name, value in (parameters or {}).items():
+            if name in DEFAULT_PREPROCESSOR_PARAMETERS:
+                self.parameters[name] = _convert_parameter(name, value)
+
+        # The block size has to be odd and at least 3
+        self.block_size = max(self.parameters["threshold_block_size"] | 1, 3)
+        self.clahe = None
+        if mode == "3":
+            tile_size = max(self.parameters["clahe_tile_size"], 1)
+            self.clahe = cv2.createCLAHE(clipLimit=self.parameters["clahe_clip_limit"],
+                                         tileGridSize=(tile_size, tile_size))
+        self.edge_mask = self.parameters["edge_mask"]
+        kernel_size = max(self.parameters["edge_refinement_kernel_size"], 1)
+        self.kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        self.buffers = {}
+
+    def _buffers(self, shape):
+        """
+        :return: Dictionary of preallocated images of the given shape, one per stage.
+        """
+        buffers = self.buffers.get(shape)
+        if buffers is None:
+            if len(self.buffers) >= MAX_BUFFER_SHAPES:
+                self.buffers.pop(next(iter(self.buffers)))
+            buffers = {name: np.empty(shape, dtype=np.uint8)
+                       for name in ("enhanced", "thresh", "edges", "dilated", "closed", "highlighted")}
+            self.buffers[shape] = buffers
+        return buffers
+
+    def __call__(self, gray_image):
+        """
+        :param gray_image: Grayscale image. It is not modified.
+        :return: The preprocessed image. It is reused by the next call.
+        """
+        buffers = self._buffers(gray_image.shape[:2])
+
+        source = gray_image
+        if self.clahe is not None:
+            source = self.clahe.apply(gray_image, buffers["enhanced"])
+
+        thresh = cv2.adaptiveThreshold(source, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, self.block_size,
+                                       self.parameters["threshold_offset"], buffers["thresh"])
+        if self.mode == "1" or not self.edge_mask:
+            return thresh
+
+        # Only keep the threshold near edges
+        edges = cv2.Canny(gray_image, self.parameters["canny_threshold_1"], self.parameters["canny_threshold_2"],
+                          buffers["edges"])
+        dilated = cv2.dilate(edges, self.kernel, buffers["dilated"], iterations=1)
+        closed = cv2.morphologyEx(dilated, cv2.MORPH_CLOSE, self.kernel, buffers["closed"], iterations=1)
+        highlighted = buffers["highlighted"]
+        highlighted.fill(0)
+        return cv2.bitwise_and(thresh, thresh, highlighted, mask=closed)
+
+
+@lru_cache(maxsize=16)
+def _cached_pipeline(mode, parameters):
+    try:
+        parsed = json.loads(parameters) if parameters.strip() else {}
+    except json.decoder.JSONDecodeError as e:
+        raise ValueError(f'Error: Could not convert parameter "preprocessor_parameters" with value "{parameters}" to a '
+                         f'JSON object.') from e
+    return PreprocessPipeline(mode, parsed if isinstance(parsed, dict) else {})
+
+
+def convert_preprocessing_mode(mode):
+    """
+    Convert a preprocessing mode received from the client.
+    :return: One of PREPROCESSING_MODES or AUTO_MODE.
+    :raises ValueError: If the mode is none of them.
+    """
+    mode = str(mode)
+    if mode not in PREPROCESSING_MODES and mode != AUTO_MODE:
+        raise ValueError(f'Error: Could not convert parameter "preprocessing_mode" with value "{mode}" to one of '
+                         f'{", ".join(PREPROCESSING_MODES + (AUTO_MODE,))}.')
+    return mode
+
+
+def get_preprocessor(mode, parameters=None):
+    """
+    Get the preprocessing pipeline for a mode and set of parameters, building it if it hasn't been used recently.
+    :param mode: Preprocessing mode, "0" to "3". Mode "0" means no preprocessing.
+    :param parameters: JSON string or dictionary of parameters, see DEFAULT_PREPROCESSOR_PARAMETERS.
+    :return: PreprocessPipeline, or None for no preprocessing.
+    :raises ValueError: For an unknown mode.
+    """
+    mode = str(mode)
+    if mode not in PREPROCESSING_MODES:
+        raise ValueError(f'Error: Could not convert parameter "preprocessing_mode" with value "{mode}" to one of '
+                         f'{", ".join(PREPROCESSING_MODES)}.')
+    if mode == PREPROCESSING_MODES[0]:
+        return None
+    # The cache is keyed on the JSON string, so it isn't even parsed again for a pipeline that is already built
+    if isinstance(parameters, dict):
+        parameters = json.dumps(parameters, sort_keys=True)
+    elif not isinstance(parameters, str):
+        parameters = ""
+    return _cached_pipeline(mode, parameters)
+
+
+class PreprocessSelector:
+    """
+    Picks the preprocessing mode for the "auto" mode. The number of tags found and the time spent on preprocessing and
+    detection are kept for every mode over a rolling window. The cheapest mode that finds about as many tags as the
+    best mode is used. When the detections drop the selector escalates to the next heavier mode right away, and every
+    so often it tries the next cheaper mode on one frame to see whether that is good enough again. While nothing is
+    found at all, the heavier modes are tried in turn instead.
+
+    Call choose before detecting tags on a frame, wrap the preprocessor with timed and call record with the result.
+    """
+    def __init__(self, window=AUTO_PREPROCESS_WINDOW, probe_interval=AUTO_PREPROCESS_PROBE_INTERVAL,
+                 recent_frames=AUTO_PREPROCESS_RECENT_FRAMES, keep_fraction=AUTO_PREPROCESS_KEEP_FRACTION):
+        self.window = window
+        self.probe_interval = probe_interval
+        self.recent_frames = recent_frames
+        self.keep_fraction = keep_fraction
+
+        self.mode = PREPROCESSING_MODES[0]
+        self.frame = 0
+        self.last_probe = 0
+        self.last_switch = 0
+        self.heavier_probes = 0
+        self.preprocess_seconds = 0.0
+        # Per mode: (frame, tags found) for the frames in the window, and (preprocessing, detection) seconds for the
+        # last window runs. Timing doesn't go stale the way the yield does when the scene changes, so it isn't expired.
+        self.yields = {mode: deque() for mode in PREPROCESSING_MODES}
+        self.times = {mode: deque(maxlen=window) for mode in PREPROCESSING_MODES}
+
+    def mean_yield(self, mode, frames=None):
+        """
+        :param frames: Only average over this many of the latest frames run with the mode.
+        :return: Average number of tags the mode found per frame within the window, or None if it wasn't run.
+        """
+        samples = [found for _, found in self.yields[mode]]
+        if frames is not None:
+            samples = samples[-frames:]
+        return sum(samples) / len(samples) if samples else None
+
+    def mean_times(self, mode):
+        """
+        :return: Average (preprocessing, detection) seconds per frame for the mode, or None if it wasn't timed yet.
+        """
+        times = self.times[mode]
+        if not times:
+            return None
+        return sum(t[0] for t in times) / len(times), sum(t[1] for t in times) / len(times)
+
+    def ranked_modes(self):
+        """
+        :return: The modes from cheapest to most expensive. Modes that haven't been timed yet are assumed to cost at
+        least as much as the modes before them in PREPROCESSING_MODES.
+        """
+        costs = {}
+        running = 0.0
+        for mode in PREPROCESSING_MODES:
+            times = self.mean_times(mode)
+            costs[mode] = running if times is None else sum(times)
+            running = max(running, costs[mode])
+        return sorted(PREPROCESSING_MODES, key=lambda mode: (costs[mode], PREPROCESSING_MODES.index(mode)))
+
+    def choose(self):
+        """
+        Start a new frame.
+        :return: The mode to use for it. This is the current mode, or a neighbor of it when it is time to probe.
+        """
+        self.frame += 1
+        self.preprocess_seconds = 0.0
+        for samples in self.yields.values():
+            while samples and samples[0][0] <= self.frame - self.window:
+                samples.popleft()
+
+        if self.frame - self.last_probe < self.probe_interval:
+            return self.mode
+        self.last_probe = self.frame
+
+        ranked = self.ranked_modes()
+        index = ranked.index(self.mode)
+        if index > 0:
+            return ranked[index - 1]
+        if not self.mean_yield(self.mode) and index < len(ranked) - 1:
+            heavier = ranked[index + 1:]
+            self.heavier_probes += 1
+            return heavier[self.heavier_probes % len(heavier)]
+        return self.mode
+
+    def timed(self, preprocess):
+        """
+        :return: The preprocessor wrapped so the time spent in it is counted for the current frame.
+        """
+        if preprocess is None:
+            return None
+
+        def timed_preprocess(gray_image):
+            start = time.perf_counter()
+            result = preprocess(gray_image)
+            self.preprocess_seconds += time.perf_counter() - start
+            return result
+        return timed_preprocess
+
+    def record(self, mode, found, seconds):
+        """
+        Record the result of the current frame and update the chosen mode.
+        :param mode: The mode returned by choose.
+        :param found: Number of tags found.
+        :param seconds: Time spent on preprocessing and detection together.
+        """
+        ranked = self.ranked_modes()
+        self.yields[mode].append((self.frame, found))
+        self.times[mode].append((self.preprocess_seconds, max(seconds - self.preprocess_seconds, 0.0)))
+
+        if mode != self.mode:
+            # A probe. A cheaper mode takes over if it keeps the yield, a heavier one if it does better.
+            current = self.mean_yield(self.mode) or 0
+            if ranked.index(mode) < ranked.index(self.mode):
+                if found >= current * self.keep_fraction:
+                    self.switch(mode)
+            elif found > current:
+                self.switch(mode)
+            return
+
+        # Give a mode a few frames before judging it, so one bad frame doesn't escalate through all of them
+        if self.frame - self.last_switch < self.recent_frames:
+            return
+        best = max(self.mean_yield(other) or 0 for other in PREPROCESSING_MODES)
+        recent = self.mean_yield(mode, self.recent_frames)
+        index = ranked.index(mode)
+        if recent < best * self.keep_fraction and index < len(ranked) - 1:
+            self.switch(ranked[index + 1])
+
+    def switch(self, mode):
+        self.mode = mode
+        self.last_switch = self.frame
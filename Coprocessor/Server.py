@@ -98,6 +98,9 @@ class Server:
             print(f"An error occurred: {e}")
             raise e
         finally:
+            # Stop anything still running for this connection, e.g. a stream
+            if hasattr(self.functional_object, "close_connection"):
+                await self.functional_object.close_connection(websocket)
             await websocket.close()
 
     # WebSocket server
@@ -191,6 +194,9 @@ class Server:
             await websocket.close()
 
     def start_server(self):
+        # Start any background work (e.g. camera capture) now that we are running in the server's own process.
+        if hasattr(self.functional_object, "start"):
+            self.functional_object.start()
         if not constants.LOCAL_HOST:
             start_server = websockets.serve(self.websocket_server, "0.0.0.0", self.port)
             print(f"Server started at ws://0.0.0.0:{self.port} for {self.functional_object.name}")
@@ -0,0 +1,243 @@
+import cv2
+import numpy as np
+
+"""
+This file contains the pose math for AprilTags, done for all the tags of a frame at once on the detection arrays
+returned by Detector.detect_array. The pose of every tag is first recovered from its homography, then refined by a few
+Gauss-Newton steps on the reprojection error of its corners, like the C library's pose_from_homography does, but for all
+the tags together and without per-tag calls into C or OpenCV.
+
+Poses are in the camera frame: x to the right, y down and z forward, like OpenCV's. The tag frame is the one of the
+library's homographies: x to the right and y up on the tag, so z points out of the tag, towards the camera.
+
+Field poses use WPILib's conventions instead, so they can be used by robot code as they are: the field layout is in
+WPILib's AprilTag field layout format, and the camera's axes are x forward, y to the left and z up.
+"""
+
+# The corners of a tag in tag coordinates, in the order Detector.detect_array returns them, for a tag of size 2. The
+# library's homographies map these (bottom left, bottom right, top right, top left) to the corners.
+TAG_OBJECT_POINTS = np.array([[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]], dtype=np.float64)
+POSE_REFINE_ITERATIONS = 10
+# Refinement stops early once no rotation (radians) or translation changes by more than this
+POSE_REFINE_TOLERANCE = 1e-4
+# The corners of a tag in the tag frame of a field layout, for a tag of size 2. That frame has x pointing out of the
+# tag, y to the right and z up as seen by a camera looking at the tag, so these are in the same order as
+# TAG_OBJECT_POINTS.
+FIELD_TAG_CORNERS = np.array([[0, -1, -1], [0, 1, -1], [0, 1, 1], [0, -1, 1]], dtype=np.float64)
+# Columns are the axes of a WPILib camera (x forward, y left, z up) in OpenCV's camera frame
+CAMERA_AXES = np.array([[0, -1, 0], [0, 0, -1], [1, 0, 0]], dtype=np.float64)
+
+
+def homography_poses(homographies, fx, fy, cx, cy, tag_size):
+    """
+    Recover the poses of tags from their homographies.
+    :param homographies: (n, 3, 3) homographies mapping tag coordinates (corners at +-1) to pixels.
+    :param fx: Horizontal focal length in pixels.
+    :param fy: Vertical focal length in pixels.
+    :param cx: Column of the optical center.
+    :param cy: Row of the optical center.
+    :param tag_size: Side of the tag's black square, in the unit the translations should be in.
+    :return: (rotations (n, 3, 3), translations (n, 3)) taking tag coordinates to camera coordinates.
+    """
+    inverse_camera = np.array([[1 / fx, 0, -cx / fx], [0, 1 / fy, -cy / fy], [0, 0, 1]])
+    # Up to scale, the columns are the tag's x and y axes and its center in the camera frame
+    columns = inverse_camera @ homographies
+    scale = 1 / np.sqrt(np.linalg.norm(columns[:, :, 0], axis=1) * np.linalg.norm(columns[:, :, 1], axis=1))
+    # The tag has to be in front of the camera
+    scale = np.where(columns[:, 2, 2] < 0, -scale, scale)
+    columns = columns * scale[:, None, None]
+
+    x_axis, y_axis = columns[:, :, 0], columns[:, :, 1]
+    rotations = np.stack([x_axis, y_axis, np.cross(x_axis, y_axis)], axis=2)
+    # Noise makes the axes not quite orthonormal, so take the closest rotation
+    u, _, vt = np.linalg.svd(rotations)
+    rotations = u @ vt
+    reflected = np.linalg.det(rotations) < 0
+    if reflected.any():
+        u[reflected, :, 2] *= -1
+        rotations[reflected] = u[reflected] @ vt[reflected]
+
+    return rotations, columns[:, :, 2] * (tag_size / 2)
+
+
+def rotation_vectors(rotations):
+    """
+    Convert rotation matrices to rotation vectors (axis times angle), like cv2.Rodrigues.
+    :param rotations: (n, 3, 3) rotation matrices.
+    :return: (n, 3) rotation vectors.
+    """
+    cos_angle = np.clip((np.trace(rotations, axis1=1, axis2=2) - 1) / 2, -1, 1)
+    angles = np.arccos(cos_angle)
+    axes = np.stack([rotations[:, 2, 1] - rotations[:, 1, 2],
+                     rotations[:, 0, 2] - rotations[:, 2, 0],
+                     rotations[:, 1, 0] - rotations[:, 0, 1]], axis=1)
+    sin_angle = np.sin(angles)
+    # angle / (2 sin(angle)) tends to 1/2 for small angles
+    factor = np.where(sin_angle > 1e-6, angles / (2 * np.maximum(sin_angle, 1e-6)), 0.5)
+    vectors = axes * factor[:, None]
+
+    # Close to half a turn the axis can't be recovered from the differences above, leave those to OpenCV
+    for index in np.flatnonzero((sin_angle <= 1e-6) & (cos_angle < 0)):
+        vectors[index] = cv2.Rodrigues(rotations[index])[0].flatten()
+    return vectors
+
+
+def skew(vectors):
+    """
+    :param vectors: (n, 3)
+    :return: (n, 3, 3) cross product matrices.
+    """
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    zero = np.zeros_like(x)
+    return np.stack([np.stack([zero, -z, y], axis=1),
+                     np.stack([z, zero, -x], axis=1),
+                     np.stack([-y, x, zero], axis=1)], axis=1)
+
+
+def rotation_matrices(vectors):
+    """
+    Convert rotation vectors to rotation matrices, the inverse of rotation_vectors.
+    :param vectors: (n, 3) rotation vectors.
+    :return: (n, 3, 3) rotation matrices.
+    """
+    angles = np.linalg.norm(vectors, axis=1)
+    axes = vectors / np.maximum(angles, 1e-12)[:, None]
+    k = skew(axes)
+    sin, cos = np.sin(angles)[:, None, None], np.cos(angles)[:, None, None]
+    return np.eye(3) + sin * k + (1 - cos) * (k @ k)
+
+
+def project(rotations, translations, object_points, fx, fy, cx, cy):
+    """
+    Project points given in tag coordinates into the image.
+    :return: (points in the camera frame (n, m, 3), pixels (n, m, 2))
+    """
+    camera_points = object_points @ rotations.transpose(0, 2, 1) + translations[:, None, :]
+    z = camera_points[:, :, 2]
+    pixels = np.stack([fx * camera_points[:, :, 0] / z + cx, fy * camera_points[:, :, 1] / z + cy], axis=2)
+    return camera_points, pixels
+
+
+def refine_poses(rotations, translations, corners, fx, fy, cx, cy, tag_size, iterations=POSE_REFINE_ITERATIONS):
+    """
+    Refine tag poses by minimizing the reprojection error of their corners with Gauss-Newton steps, for all tags at
+    once.
+    :param rotations: (n, 3, 3) initial rotations, e.g. from homography_poses.
+    :param translations: (n, 3) initial translations.
+    :param corners: (n, 4, 2) detected corners in pixels.
+    :param tag_size: Side of the tag's black square.
+    :return: (rotations, translations, reprojection errors (n,) as the RMS corner distance in pixels)
+    """
+    object_points = TAG_OBJECT_POINTS * (tag_size / 2)
+    # Rows are the derivatives of u and v of every corner with respect to a small rotation w applied on the left of
+    # the rotation and to the translation
+    jacobian = np.empty((len(rotations), 4, 2, 6))
+    for _ in range(iterations):
+        camera_points, pixels = project(rotations, translations, object_points, fx, fy, cx, cy)
+        residuals = (pixels - corners).reshape(-1, 8, 1)
+
+        # The rotated corners, before the translation
+        qx, qy, qz = (camera_points - translations[:, None, :]).transpose(2, 0, 1)
+        x, y, z = camera_points.transpose(2, 0, 1)
+        a, b = fx / z, fy / z
+        c, e = -a * x / z, -b * y / z
+        jacobian[:, :, 0] = np.stack([c * qy, a * qz - c * qx, -a * qy, a, np.zeros_like(a), c], axis=2)
+        jacobian[:, :, 1] = np.stack([e * qy - b * qz, -e * qx, b * qx, np.zeros_like(b), b, e], axis=2)
+        flat = jacobian.reshape(-1, 8, 6)
+
+        normal = flat.transpose(0, 2, 1) @ flat + 1e-9 * np.eye(6)
+        step = np.linalg.solve(normal, -(flat.transpose(0, 2, 1) @ residuals))[:, :, 0]
+        rotations = rotation_matrices(step[:, :3]) @ rotations
+        translations = translations + step[:, 3:]
+        if not step.size or np.abs(step).max() < POSE_REFINE_TOLERANCE:
+            break
+
+    _, pixels = project(rotations, translations, object_points, fx, fy, cx, cy)
+    errors = np.sqrt(((pixels - corners) ** 2).sum(axis=2).mean(axis=1))
+    return rotations, translations, errors
+
+
+def tag_poses(tags, fx, fy, cx, cy, tag_size):
+    """
+    Find the poses of all the tags in a detection array.
+    :param tags: Detection array as returned by Detector.detect_array.
+    :return: (rotations (n, 3, 3), translations (n, 3), reprojection errors (n,))
+    """
+    rotations, translations = homography_poses(tags["homography"], fx, fy, cx, cy, tag_size)
+    return refine_poses(rotations, translations, tags["corners"], fx, fy, cx, cy, tag_size)
+
+
+def quaternion_matrix(w, x, y, z):
+    """
+    :return: The rotation matrix of a quaternion, which does not need to be normalized.
+    """
+    norm = np.sqrt(w * w + x * x + y * y + z * z)
+    w, x, y, z = w / norm, x / norm, y / norm, z / norm
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)],
+                     [2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)],
+                     [2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)]])
+
+
+class FieldLayout:
+    """
+    The poses of the AprilTags on the field. Used to find the pose of the camera on the field with a single PnP solve
+    over the corners of all the tags it sees, which is cheaper and much more stable than a pose per tag fused
+    afterwards.
+    """
+    def __init__(self, layout, tag_size):
+        """
+        :param layout: Dictionary in WPILib's AprilTag field layout format, in meters:
+        {"tags": [{"ID": 1, "pose": {"translation": {"x": 0, "y": 0, "z": 0},
+        "rotation": {"quaternion": {"W": 1, "X": 0, "Y": 0, "Z": 0}}}}, ...], ...}
+        :param tag_size: Side of the tags' black square, in meters.
+        :raises ValueError: If the layout is invalid.
+        """
+        ids = []
+        corners = []
+        try:
+            for tag in layout["tags"]:
+                translation = tag["pose"]["translation"]
+                quaternion = tag["pose"]["rotation"]["quaternion"]
+                rotation = quaternion_matrix(*(float(quaternion[key]) for key in "WXYZ"))
+                position = np.array([float(translation[key]) for key in "xyz"])
+                ids.append(int(tag["ID"]))
+                corners.append(FIELD_TAG_CORNERS * (tag_size / 2) @ rotation.T + position)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid field layout ({type(e).__name__}: {e}).") from e
+        if len(set(ids)) != len(ids):
+            raise ValueError("Invalid field layout, a tag ID appears more than once.")
+
+        # Sorted by ID so the tags of a detection array can be looked up with searchsorted
+        order = np.argsort(ids)
+        self.ids = np.array(ids, dtype=np.int32)[order]
+        self.corners = np.array(corners, dtype=np.float64).reshape(-1, 4, 3)[order]
+
+    def camera_pose(self, tags, fx, fy, cx, cy):
+        """
+        Find the pose of the camera on the field from all the tags of a detection array that are in the layout.
+        :param tags: Detection array as returned by Detector.detect_array.
+        :return: (position (3,), rotation (3, 3) of the camera in field coordinates, RMS reprojection error in pixels,
+        IDs of the tags used), or None if no tag of the layout was detected.
+        """
+        known = tags[np.isin(tags["tag_id"], self.ids)]
+        if len(known) == 0:
+            return None
+
+        object_points = self.corners[np.searchsorted(self.ids, known["tag_id"])].reshape(-1, 3)
+        image_points = known["corners"].reshape(-1, 2).astype(np.float64)
+        camera_matrix = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]], dtype=np.float64)
+        found, rotation_vector, translation = cv2.solvePnP(object_points, image_points, camera_matrix, None,
+                                                           flags=cv2.SOLVEPNP_SQPNP)
+        if not found:
+            return None
+        rotation_vector, translation = cv2.solvePnPRefineLM(object_points, image_points, camera_matrix, None,
+                                                            rotation_vector, translation)
+
+        projected, _ = cv2.projectPoints(object_points, rotation_vector, translation, camera_matrix, None)
+        error = np.sqrt(((projected.reshape(-1, 2) - image_points) ** 2).sum(axis=1).mean())
+
+        # solvePnP gives the field in the camera frame, invert it to get the camera on the field
+        rotation = cv2.Rodrigues(rotation_vector)[0].T
+        position = -rotation @ translation.flatten()
+        return position, rotation @ CAMERA_AXES, float(error), known["tag_id"]
+
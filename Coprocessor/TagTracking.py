@@ -0,0 +1,277 @@
+import cv2
+import numpy as np
+from apriltag import DETECTION_DTYPE
+from constants import (TRACKING_RESCAN_INTERVAL, TRACKING_PADDING, PYRAMID_LEVELS, PYRAMID_MIN_TAG_PIXELS,
+                       PYRAMID_BAND_ANGLE)
+
+"""
+This file contains the TagTracker class which speeds up AprilTag detection on a stream of frames. Tags usually move
+only a few pixels from one frame to the next, so once they have been found on the whole frame, the next frames are only
+searched in padded regions around where the tags were last seen. The whole frame is searched again every few frames,
+to pick up tags that came into view, and whenever a tracked tag is not found in its region.
+
+It also contains detect_scaled, which finds tags on a shrunk copy of the image, where detection is much cheaper, and
+then refines their corners on the full resolution image so the pose is nearly as accurate as a full resolution search,
+and detect_pyramid, which starts with a heavily shrunk image and only searches at higher resolution, near the horizon
+where far away tags show up, if it finds nothing or only small tags.
+
+Detections are the structured arrays returned by Detector.detect_array (one record per tag), always in full frame
+coordinates. The functions here work on all the tags of an array at once where they can.
+"""
+
+# The points a tag's homography maps to its corners, in the order Detector.detect returns the corners (bottom left,
+# bottom right, top right, top left), like the library's own homographies
+TAG_CORNERS = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float32)
+REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+
+
+def offset_detections(tags, x, y):
+    """
+    Move detections made on a crop of the frame back into full frame coordinates.
+    :param tags: Detection array as returned by Detector.detect_array
+    :param x: Column of the crop's top left corner in the frame.
+    :param y: Row of the crop's top left corner in the frame.
+    :return: The same array, with center, corners and homography moved.
+    """
+    if x == 0 and y == 0:
+        return tags
+    tags["center"] += (x, y)
+    tags["corners"] += (x, y)
+    # The homography maps tag coordinates to pixels, so the translation is applied after it
+    translation = np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+    tags["homography"] = translation @ tags["homography"]
+    return tags
+
+
+def scale_detections(tags, scale_x, scale_y):
+    """
+    Move detections made on a resized image to the coordinates of the original image.
+    :param tags: Detection array as returned by Detector.detect_array
+    :param scale_x: Original width divided by the resized width.
+    :param scale_y: Original height divided by the resized height.
+    :return: The same array, with center, corners and homography scaled.
+    """
+    # Pixel centers line up at (x + 0.5) * scale - 0.5
+    scale = np.array([[scale_x, 0, 0.5 * scale_x - 0.5], [0, scale_y, 0.5 * scale_y - 0.5], [0, 0, 1]])
+    factor = np.array([scale_x, scale_y])
+    shift = 0.5 * factor - 0.5
+    tags["center"] = tags["center"] * factor + shift
+    tags["corners"] = tags["corners"] * factor + shift
+    tags["homography"] = scale @ tags["homography"]
+    return tags
+
+
+def refine_detections(tags, gray_image, window):
+    """
+    Refine the detections' corners to sub-pixel accuracy on the full resolution image and recompute their homographies
+    and centers from them. A detection is left as it is if the tag is too small to refine or refinement goes astray.
+    :param tags: Detection array in the coordinates of gray_image.
+    :param gray_image: The full resolution grayscale image, not preprocessed.
+    :param window: Half the size of the search window in pixels. Limited to a fraction of a cell of each tag.
+    :return: The same array.
+    """
+    # Stay inside the tags' black border, which is one of 8 cells across
+    windows = np.minimum(window, (tag_sizes(tags) / 16).astype(int))
+    for tag, tag_window in zip(tags, windows):
+        if tag_window < 1:
+            continue
+        corners = tag["corners"].astype(np.float32)
+        refined = cv2.cornerSubPix(gray_image, corners.reshape(-1, 1, 2), (int(tag_window), int(tag_window)),
+                                   (-1, -1), REFINE_CRITERIA).reshape(-1, 2)
+        if np.abs(refined - corners).max() > 2 * tag_window:
+            continue
+
+        homography = cv2.getPerspectiveTransform(TAG_CORNERS, refined)
+        tag["corners"] = refined
+        tag["homography"] = homography
+        tag["center"] = homography[:2, 2] / homography[2, 2]
+    return tags
+
+
+def detect_scaled(detector, gray_image, preprocess=None, decimation=1):
+    """
+    Detect tags on the image shrunk by the decimation factor, then refine the corners on the full image.
+    :param detector: apriltag.Detector
+    :param gray_image: The grayscale image.
+    :param preprocess: Function applied to the shrunk image before it is handed to the detector, or None.
+    :param decimation: How much to shrink the image by. 1 or less searches the image as it is.
+    :return: Detection array in the coordinates of gray_image.
+    """
+    if decimation <= 1:
+        return detector.detect_array(gray_image if preprocess is None else preprocess(gray_image))
+
+    height, width = gray_image.shape[:2]
+    small_size = (max(int(width / decimation), 1), max(int(height / decimation), 1))
+    small = cv2.resize(gray_image, small_size, interpolation=cv2.INTER_AREA)
+    tags = detector.detect_array(small if preprocess is None else preprocess(small))
+
+    scale_x, scale_y = width / small_size[0], height / small_size[1]
+    window = max(int(round(decimation * 1.5)), 2)
+    return refine_detections(scale_detections(tags, scale_x, scale_y), gray_image, window)
+
+
+def tag_sizes(tags):
+    """
+    :return: Length of the shortest side of every detected tag in pixels.
+    """
+    corners = tags["corners"]
+    return np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2).min(axis=1)
+
+
+def horizon_band(height, focal_length, tilt_angle, band_angle=PYRAMID_BAND_ANGLE):
+    """
+    Find the rows of the image within band_angle of the horizon. Far away tags can only show up there.
+    :param height: Height of the image in pixels.
+    :param focal_length: Vertical focal length in pixels, at the image's resolution.
+    :param tilt_angle: Tilt of the camera. 0 is looking straight down, pi/2 is looking straight ahead.
+    :param band_angle: How far above and below the horizon to include, in radians.
+    :return: (first row, last row + 1), or None if the band is not in the image.
+    """
+    # Angle of the horizon above the optical axis
+    horizon = np.pi / 2 - tilt_angle
+    top = height / 2 - focal_length * np.tan(min(horizon + band_angle, np.pi / 2 - 1e-3))
+    bottom = height / 2 - focal_length * np.tan(max(horizon - band_angle, -np.pi / 2 + 1e-3))
+    top, bottom = max(int(top), 0), min(int(np.ceil(bottom)), height)
+    if bottom <= top:
+        return None
+    return top, bottom
+
+
+def merge_detections(coarse, fine):
+    """
+    Combine detections from two searches. A tag found in both is taken from the fine search.
+    :return: Detection array.
+    """
+    if len(coarse) == 0 or len(fine) == 0:
+        return np.concatenate([coarse, fine])
+    # Compare every coarse detection with every fine one
+    same_id = coarse["tag_id"][:, None] == fine["tag_id"][None, :]
+    distance = np.linalg.norm(coarse["center"][:, None] - fine["center"][None, :], axis=2)
+    duplicate = (same_id & (distance < tag_sizes(fine)[None, :])).any(axis=1)
+    return np.concatenate([coarse[~duplicate], fine])
+
+
+def detect_pyramid(detector, gray_image, preprocess=None, levels=PYRAMID_LEVELS, band=None,
+                   min_tag_pixels=PYRAMID_MIN_TAG_PIXELS):
+    """
+    Search the whole image at the coarsest level, then go on to finer levels while the last search found no tags or
+    found tags smaller than min_tag_pixels. The finer levels only search the band of rows where far tags can be.
+    :param detector: apriltag.Detector
+    :param gray_image: The grayscale image.
+    :param preprocess: Function applied to every image before it is handed to the detector, or None.
+    :param levels: Decimation factors from coarse to fine.
+    :param band: (first row, last row + 1) to search at the finer levels, see horizon_band. None stops at the first
+    level.
+    :param min_tag_pixels: Tags smaller than this, in pixels at the level they were found at, make the search go on.
+    :return: (detections, decimation of the finest level searched)
+    """
+    level = levels[0]
+    tags = found = detect_scaled(detector, gray_image, preprocess, level)
+    for finer in levels[1:]:
+        if band is None or (len(found) and tag_sizes(found).min() / level >= min_tag_pixels):
+            break
+        top, bottom = band
+        found = offset_detections(detect_scaled(detector, gray_image[top:bottom], preprocess, finer), 0, top)
+        tags = merge_detections(tags, found)
+        level = finer
+    return tags, level
+
+
+def tag_regions(tags, shape, padding):
+    """
+    Find the regions of the frame to search for the given tags. Every tag's bounding box is grown by padding times its
+    size, and boxes that overlap are merged so no part of the frame is searched twice.
+    :param tags: Detections from the previous frame.
+    :param shape: Shape of the frame.
+    :param padding: How far to grow the boxes, as a fraction of the tag's size.
+    :return: List of (x0, y0, x1, y1)
+    """
+    height, width = shape[:2]
+    low = tags["corners"].min(axis=1)
+    high = tags["corners"].max(axis=1)
+    pad = padding * (high - low).max(axis=1, keepdims=True)
+    low = np.maximum((low - pad).astype(int), 0)
+    high = np.minimum(np.ceil(high + pad).astype(int), (width, height))
+    boxes = np.hstack([low, high]).tolist()
+
+    merged = []
+    while boxes:
+        box = boxes.pop()
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in boxes:
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    box = [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])]
+                    boxes.remove(other)
+                    overlapping = True
+                    break
+        merged.append(tuple(box))
+    return merged
+
+
+class TagTracker:
+    """
+    Keeps track of the tags found on the last frame and decides where to look for them on the next one.
+    """
+    def __init__(self, detector, rescan_interval=TRACKING_RESCAN_INTERVAL, padding=TRACKING_PADDING):
+        """
+        :param detector: apriltag.Detector
+        :param rescan_interval: Search the whole frame at least every this many frames.
+        :param padding: How far around a tag's last position to search, as a fraction of the tag's size. This is scaled
+        up if frames were skipped since the tag was last seen.
+        """
+        self.detector = detector
+        self.rescan_interval = rescan_interval
+        self.padding = padding
+        self.tracked = np.empty(0, dtype=DETECTION_DTYPE)
+        self.last_sequence = None
+        self.frames_since_scan = 0
+
+    def reset(self):
+        self.tracked = np.empty(0, dtype=DETECTION_DTYPE)
+        self.last_sequence = None
+
+    def detect(self, gray_image, preprocess=None, sequence=None, rescan_interval=None, decimation=1, full_search=None):
+        """
+        Detect tags, searching only around the tags from the last frame when possible.
+        :param gray_image: The full grayscale frame.
+        :param preprocess: Function applied to every image before it is handed to the detector, or None.
+        :param sequence: Sequence number of the frame. Used to grow the search regions if frames were skipped.
+        :param rescan_interval: Overrides the tracker's rescan interval for this call.
+        :param decimation: Search shrunk images, see detect_scaled.
+        :param full_search: Function used to search the whole frame instead of detect_scaled, e.g. a pyramid search.
+        It gets the frame and returns the detections.
+        :return: (detections, full_scan) where full_scan is True if the whole frame was searched.
+        """
+        if rescan_interval is None:
+            rescan_interval = self.rescan_interval
+
+        # The same frame again, e.g. a client polling faster than the camera runs: the tags are where they were found
+        if sequence is not None and sequence == self.last_sequence:
+            return self.tracked.copy(), False
+
+        skipped = 1
+        if sequence is not None and self.last_sequence is not None:
+            skipped = sequence - self.last_sequence
+        self.last_sequence = sequence
+
+        if len(self.tracked) and 0 < skipped and self.frames_since_scan < rescan_interval:
+            padding = self.padding * min(skipped, 4)
+            tags = np.concatenate([np.empty(0, dtype=DETECTION_DTYPE)] + [
+                offset_detections(detect_scaled(self.detector, gray_image[y0:y1, x0:x1], preprocess, decimation),
+                                  x0, y0)
+                for x0, y0, x1, y1 in tag_regions(self.tracked, gray_image.shape, padding)])
+            if np.isin(self.tracked["tag_id"], tags["tag_id"]).all():
+                self.frames_since_scan += 1
+                self.tracked = tags
+                return tags, False
+
+        # Either nothing is being tracked, it is time for a rescan, or a tag got away
+        if full_search is not None:
+            tags = full_search(gray_image)
+        else:
+            tags = detect_scaled(self.detector, gray_image, preprocess, decimation)
+        self.frames_since_scan = 0
+        self.tracked = tags
+        return tags, True
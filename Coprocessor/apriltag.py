@@ -103,6 +103,89 @@ class _ApriltagDetector(ctypes.Structure):
     ]
 
 
+######################################################################
+
+# Layout of the fixed part of the apriltag_detection C struct, so the
+# detections can be copied out with one memmove each and their fields
+# read for all of them at once.
+_DETECTION_STRUCT_DTYPE = np.dtype({
+    'names': ['family', 'id', 'hamming', 'goodness', 'decision_margin',
+              'H', 'c', 'p'],
+    'formats': [np.uintp, np.int32, np.int32, np.float32, np.float32,
+                np.uintp, (np.float64, (2,)), (np.float64, (4, 2))],
+    'offsets': [_ApriltagDetection.family.offset,
+                _ApriltagDetection.id.offset,
+                _ApriltagDetection.hamming.offset,
+                _ApriltagDetection.goodness.offset,
+                _ApriltagDetection.decision_margin.offset,
+                _ApriltagDetection.H.offset,
+                _ApriltagDetection.c.offset,
+                _ApriltagDetection.p.offset],
+    'itemsize': ctypes.sizeof(_ApriltagDetection)})
+
+# The detections returned by Detector.detect_array, one record per tag.
+DETECTION_DTYPE = np.dtype([
+    ('tag_family', 'U16'),
+    ('tag_id', np.int32),
+    ('hamming', np.int32),
+    ('goodness', np.float32),
+    ('decision_margin', np.float32),
+    ('center', np.float64, (2,)),
+    ('corners', np.float64, (4, 2)),
+    ('homography', np.float64, (3, 3)),
+])
+
+
+def detection_dict(detection):
+    '''Convert a record of the array returned by Detector.detect_array
+to the dictionary returned by Detector.detect.'''
+    return {
+        'tag_family': str(detection['tag_family']),
+        'tag_id': int(detection['tag_id']),
+        'hamming': int(detection['hamming']),
+        'goodness': float(detection['goodness']),
+        'decision_margin': float(detection['decision_margin']),
+        'homography': detection['homography'].tolist(),
+        'center': detection['center'].tolist(),
+        'corners': detection['corners'].tolist()
+    }
+
+
+class TagFilter(object):
+    '''Which detections Detector.detect_array keeps. Rejected tags are
+dropped as soon as the detections are read from C, so no pose work is
+done for them. A criterion that is None (or 0 for the decision margin)
+accepts every tag.
+
+    '''
+
+    def __init__(self, tag_ids=None, tag_family=None,
+                 min_decision_margin=0.0, max_hamming=None):
+        self.tag_ids = (None if tag_ids is None
+                        else np.unique(np.asarray(tag_ids, dtype=np.int32)))
+        self.tag_family = tag_family
+        self.min_decision_margin = min_decision_margin
+        self.max_hamming = max_hamming
+
+    def mask(self, detections):
+        '''Boolean mask of the records of a DETECTION_DTYPE array that
+pass the filter.'''
+        keep = np.ones(len(detections), dtype=bool)
+        if self.tag_ids is not None:
+            keep &= np.isin(detections['tag_id'], self.tag_ids)
+        if self.tag_family is not None:
+            keep &= detections['tag_family'] == self.tag_family
+        if self.min_decision_margin:
+            keep &= detections['decision_margin'] >= self.min_decision_margin
+        if self.max_hamming is not None:
+            keep &= detections['hamming'] <= self.max_hamming
+        return keep
+
+
+# How many differently sized C images Detector keeps for reuse. Tag
+# tracking searches crops that change size, so this is bounded.
+IMAGE_POOL_SIZE = 8
+
 ######################################################################
 
 def _ptr_to_array2d(datatype, ptr, rows, cols):
@@ -292,6 +375,13 @@ library used by ctypes.
 
         self.libc = None
         self.tag_detector = None
+        self._family_names = {}
+        # TagFilter applied by detect and detect_array, or None to keep
+        # every tag
+        self.tag_filter = None
+        # C images to copy frames into, by (width, height), least
+        # recently used first
+        self._image_pool = collections.OrderedDict()
 
         for path in searchpath:
             relpath = os.path.join(path, filename)
@@ -313,12 +403,12 @@ library used by ctypes.
 
         # create the c-_apriltag_detector object
         self.tag_detector = self.libc.apriltag_detector_create()
-        self.tag_detector.contents.nthreads = int(options.nthreads)
-        self.tag_detector.contents.quad_decimate = float(options.quad_decimate)
-        self.tag_detector.contents.quad_sigma = float(options.quad_sigma)
-        self.tag_detector.refine_edges = int(options.refine_edges)
-        self.tag_detector.refine_decode = int(options.refine_decode)
-        self.tag_detector.refine_pose = int(options.refine_pose)
+        self.set_options(nthreads=options.nthreads,
+                         quad_decimate=options.quad_decimate,
+                         quad_blur=options.quad_sigma,
+                         refine_edges=options.refine_edges,
+                         refine_decode=options.refine_decode,
+                         refine_pose=options.refine_pose)
 
         if options.quad_contours:
             self.libc.apriltag_detector_enable_quad_contours(self.tag_detector, 1)
@@ -345,48 +435,115 @@ library used by ctypes.
         for family in families_list:
             self.add_tag_family(family)
 
+    def set_options(self, nthreads=None, quad_decimate=None, quad_blur=None,
+                    refine_edges=None, refine_decode=None, refine_pose=None):
+        '''Change the parameters of the C detector in place, without
+recreating it. Parameters that are None are left alone. The new
+values are also stored in self.options.
+
+        '''
+
+        detector = self.tag_detector.contents
+
+        if nthreads is not None:
+            self.options.nthreads = detector.nthreads = int(nthreads)
+        if quad_decimate is not None:
+            self.options.quad_decimate = detector.quad_decimate = float(quad_decimate)
+        if quad_blur is not None:
+            self.options.quad_sigma = detector.quad_sigma = float(quad_blur)
+        if refine_edges is not None:
+            self.options.refine_edges = detector.refine_edges = int(refine_edges)
+        if refine_decode is not None:
+            self.options.refine_decode = detector.refine_decode = int(refine_decode)
+        if refine_pose is not None:
+            self.options.refine_pose = detector.refine_pose = int(refine_pose)
+
     def __del__(self):
+        for c_img in getattr(self, '_image_pool', {}).values():
+            self.libc.image_u8_destroy(c_img)
         if self.tag_detector is not None:
             self.libc.apriltag_detector_destroy(self.tag_detector)
 
     def detect(self, img, return_image=False):
         """assert len(img.shape) == 2
         assert img.dtype == np.uint8"""
-        c_img = self._convert_image(img)
+        if return_image:
+            detections, dimg = self.detect_array(img, return_image=True)
+            return [detection_dict(d) for d in detections], dimg
+        return [detection_dict(d) for d in self.detect_array(img)]
+
+    def detect_array(self, img, return_image=False):
+        '''Detect tags like detect, but return them as one NumPy
+structured array with DETECTION_DTYPE instead of a list of
+dictionaries. This skips building Python objects for every tag.
+
+        '''
+
+        # The C image is either a view of img or a pooled buffer, so
+        # it is not destroyed after detection
+        c_img = self._wrap_image(img)
+        if c_img is None:
+            c_img = self._convert_image(img)
         detections = self.libc.apriltag_detector_detect(self.tag_detector, c_img)
-        apriltag = ctypes.POINTER(_ApriltagDetection)()
-
-        detected_tags = []
-
-        for i in range(0, detections.contents.size):
-            self.libc.zarray_get(detections, i, ctypes.byref(apriltag))
-            tag = apriltag.contents
-
-            homography = _matd_get_array(tag.H).copy()
-            center = np.ctypeslib.as_array(tag.c, shape=(2,)).copy()
-            corners = np.ctypeslib.as_array(tag.p, shape=(4, 2)).copy()
-
-            tag_dict = {
-                'tag_family': ctypes.string_at(tag.family.contents.name).decode('utf-8'),
-                'tag_id': tag.id,
-                'hamming': tag.hamming,
-                'goodness': tag.goodness,
-                'decision_margin': tag.decision_margin,
-                'homography': homography.tolist(),
-                'center': center.tolist(),
-                'corners': corners.tolist()
-            }
-
-            detected_tags.append(tag_dict)
+        count = detections.contents.size
+
+        # The zarray holds pointers to the detections. Copy the structs
+        # next to each other so all their fields can be read at once.
+        raw = np.empty(count, dtype=_DETECTION_STRUCT_DTYPE)
+        result = np.empty(count, dtype=DETECTION_DTYPE)
+        if count:
+            pointers = (ctypes.c_void_p * count).from_address(detections.contents.data)
+            itemsize = _DETECTION_STRUCT_DTYPE.itemsize
+            for i, pointer in enumerate(pointers):
+                ctypes.memmove(raw.ctypes.data + i * itemsize, pointer, itemsize)
+
+            result['tag_family'] = [self._family_name(int(family)) for family in raw['family']]
+            result['tag_id'] = raw['id']
+            result['hamming'] = raw['hamming']
+            result['goodness'] = raw['goodness']
+            result['decision_margin'] = raw['decision_margin']
+            result['center'] = raw['c']
+            result['corners'] = raw['p']
+
+            # Drop the rejected tags before their homographies are
+            # copied out
+            if self.tag_filter is not None:
+                keep = self.tag_filter.mask(result)
+                raw, result = raw[keep], result[keep]
+
+            homographies = result['homography']
+            for i, matd in enumerate(raw['H']):
+                ctypes.memmove(homographies[i].ctypes.data, int(matd) + _Matd.data.offset, 9 * 8)
+
+        dimg = None
+        if return_image:
+            if len(result) < count:
+                # Only draw the tags that passed the filter, from a zarray
+                # of their pointers
+                kept = (ctypes.c_void_p * len(result))(
+                    *[pointers[i] for i in np.flatnonzero(keep)])
+                visible = _ZArray(ctypes.sizeof(ctypes.c_void_p), len(result),
+                                  len(result), ctypes.addressof(kept))
+                dimg = self._vis_detections(img.shape, ctypes.pointer(visible))
+            else:
+                dimg = self._vis_detections(img.shape, detections)
 
-        self.libc.image_u8_destroy(c_img)
         self.libc.apriltag_detections_destroy(detections)
 
         if return_image:
-            dimg = self._vis_detections(img.shape, detections)
-            return detected_tags, dimg
-        else:
-            return detected_tags
+            return result, dimg
+        return result
+
+    def _family_name(self, address):
+        '''Name of the apriltag_family at the given address. The families
+live as long as the detector, so the names are cached.'''
+
+        name = self._family_names.get(address)
+        if name is None:
+            family = ctypes.cast(address, ctypes.POINTER(_ApriltagFamily))
+            name = ctypes.string_at(family.contents.name).decode('utf-8')
+            self._family_names[address] = name
+        return name
 
     def add_tag_family(self, name):
 
@@ -457,11 +614,44 @@ library used by ctypes.
         self.libc.pose_from_homography.restype = ctypes.POINTER(_Matd)
         self.libc.matd_create.restype = ctypes.POINTER(_Matd)
 
+    def _wrap_image(self, img):
+        '''Describe img to the C library without copying it. This works
+for 2D uint8 arrays whose pixels are next to each other within a row,
+since image_u8 only needs a row stride in bytes, which covers views of
+a part of a larger image too. The detector blurs an undecimated image
+in place when quad_sigma is set, so then the frame is not wrapped.
+
+Returns a pointer to an image_u8 that must not be destroyed, or None
+if img can't be wrapped. It is only valid while img is alive.
+
+        '''
+
+        if (img.dtype != np.uint8 or img.ndim != 2 or img.strides[1] != 1
+                or img.strides[0] < img.shape[1]
+                or self.tag_detector.contents.quad_sigma != 0):
+            return None
+        image = _ImageU8(width=img.shape[1], height=img.shape[0],
+                         stride=img.strides[0],
+                         buf=img.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)))
+        # Keep the array alive as long as the struct
+        image._array = img
+        return ctypes.pointer(image)
+
     def _convert_image(self, img):
+        '''Copy img into a C image. The C images are pooled by size and
+reused by the next detection, so don't destroy the result.'''
 
         height = img.shape[0]
         width = img.shape[1]
-        c_img = self.libc.image_u8_create(width, height)
+        c_img = self._image_pool.get((width, height))
+        if c_img is None:
+            if len(self._image_pool) >= IMAGE_POOL_SIZE:
+                _, oldest = self._image_pool.popitem(last=False)
+                self.libc.image_u8_destroy(oldest)
+            c_img = self.libc.image_u8_create(width, height)
+            self._image_pool[(width, height)] = c_img
+        else:
+            self._image_pool.move_to_end((width, height))
 
         tmp = _image_u8_get_array(c_img)
 
@@ -26,10 +26,75 @@ CAMERA_HEIGHT = defaults["camera_height"]  # This is the height of the camera in
 APRIL_TAG_WIDTH = defaults["april_tag_width"]  # This is the width of the AprilTag in meters
 APRIL_TAG_HEIGHT = defaults["april_tag_height"]  # This is the height of the AprilTag in meters
 RECORD = False
+CAPTURE_MODE = "decoded"  # "decoded", "mjpeg" or "gray", see CAPTURE_MODES in Capture.py
 
 IMAGE_FORMAT = "jpg"
 LOCAL_HOST = True
 
+CAMERA_RECONNECT_INITIAL_DELAY = 0.25  # Seconds to wait before the first attempt to reopen a camera that stopped working
+CAMERA_RECONNECT_MAX_DELAY = 8.0  # The delay doubles after every failed attempt up to this many seconds
+CAMERA_LOST_AFTER_ATTEMPTS = 5  # After this many failed attempts the camera is reported as lost (we keep trying though)
+CAMERA_FRAME_WAIT_TIMEOUT = 1.0  # Seconds the capture thread waits for a frame before it tries to grab one anyway
+
+# Default AprilTag detector options. They can be changed per camera with set_detector_options.
+DETECTOR_OPTIONS = {
+    "nthreads": 4,  # Threads the detector uses, on the cores its camera's server gets (see camera_cores in main.py)
+    "quad_decimate": 1.0,  # Look for quads on the image shrunk by this factor. Faster, but shortens the range.
+    "quad_blur": 0.0,  # Gaussian blur (sigma) applied before looking for quads. Helps with noisy images.
+    "refine_edges": True,  # Snap the quad edges to strong gradients
+    "refine_decode": False,  # Spend more time trying to decode tags
+    "refine_pose": False,  # Spend more time trying to precisely localize tags
+}
+
+# Default AprilTag filters. Rejected tags are dropped before any pose work. They can be changed per camera with
+# set_tag_filter and per request in apriltag.
+TAG_FILTER = {
+    "tag_ids": None,  # Only keep these tag IDs. None keeps every ID.
+    "tag_family": None,  # Only keep tags of this family, e.g. "tag36h11". None keeps every family.
+    "min_decision_margin": 0.0,  # Drop tags decoded with a smaller margin. Low margins are often false detections.
+    "max_hamming": None,  # Drop tags with more corrected bits than this. None keeps what the detector accepts.
+}
+
+# Per-tag constant velocity filter used by apriltag's predict (see MotionFilter.py). The noise values are standard
+# deviations: how far off a single measurement can be, and how hard a tag can accelerate relative to the camera.
+MOTION_FILTER_POSITION_NOISE = 0.03  # Meters, for the position and the distance
+MOTION_FILTER_ANGLE_NOISE = 0.01  # Radians
+MOTION_FILTER_POSITION_ACCELERATION = 5.0  # Meters per second squared
+MOTION_FILTER_ANGLE_ACCELERATION = 5.0  # Radians per second squared
+MOTION_FILTER_DROPOUT = 0.3  # Seconds a tag that is no longer detected keeps being predicted
+
+# Threads per camera that run AprilTag detection, pose estimation and JPEG encoding off the server's event loop
+WORKER_THREADS = 2
+# Size of the queue in front of each stage of a streaming pipeline (see Pipeline.py). When it is full the oldest frame is
+# dropped.
+PIPELINE_QUEUE_SIZE = 1
+
+# AprilTag tracking (see TagTracking.py)
+TRACKING_RESCAN_INTERVAL = 10  # Search the whole frame at least every this many frames to find new tags
+TRACKING_PADDING = 0.5  # Search this far around a tag's last position, as a fraction of the tag's size
+
+# AprilTag pyramid search (see TagTracking.py). Tags are searched at the first decimation factor, and at the following
+# ones near the horizon if nothing or only small tags were found.
+PYRAMID_LEVELS = (4, 2, 1)
+PYRAMID_MIN_TAG_PIXELS = 16  # Tags smaller than this (in pixels at the level they were found at) make the search go on
+PYRAMID_BAND_ANGLE = 0.2  # Far tags are searched within this many radians above and below the horizon
+
+# Piece detection first looks for the target color on every this many pixels in each direction, and skips the frame if
+# it is not found (see Locater.py). Objects smaller than this can be missed.
+PIECE_PRESENCE_STEP = 4
+
+# Automatic preprocessing mode selection (see Preprocess.py)
+AUTO_PREPROCESS_WINDOW = 30  # Detection yield and time of each mode are averaged over this many frames
+AUTO_PREPROCESS_PROBE_INTERVAL = 15  # Try a cheaper (or, if nothing is found, heavier) mode every this many frames
+AUTO_PREPROCESS_RECENT_FRAMES = 3  # Escalate when the yield over this many frames drops below the best mode's
+AUTO_PREPROCESS_KEEP_FRACTION = 0.9  # A mode keeps the yield if it finds at least this fraction of the best mode's tags
+
+# Settings for replaying recordings instead of a live camera (see main.py --replay). These can be overridden from the
+# command line.
+REPLAY_PACING = "realtime"  # "realtime" plays videos at their own frame rate, "fixed" at REPLAY_FPS, "fast" without waiting
+REPLAY_FPS = 30.0  # Frame rate for "fixed" pacing, and for image directories with "realtime" pacing
+REPLAY_LOOP = True  # Start over at the end instead of reporting the camera as lost
+
 HORIZONTAL_FOCAL_LENGTH = ((CAMERA_HORIZONTAL_RESOLUTION_PIXELS / 2) /
                            np.tan(CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS / 2))
 VERTICAL_FOCAL_LENGTH = (CAMERA_VERTICAL_RESOLUTION_PIXELS / 2) / np.tan(CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS / 2)
@@ -1,5 +1,8 @@
 import time
+import argparse
 from Server import Server
+from Backends import REPLAY_PACINGS, SYNTHETIC_PREFIX, is_synthetic_source
+import constants
 import os
 import psutil
 import multiprocessing
@@ -82,18 +85,65 @@ def name_valid_cams():
     logging.info(f"Processed known_devices: {known_devices}")
     return known_devices
 
-def start_server_with_affinity(server, cpu_core):
-    logging.info(f"Starting server on CPU core {cpu_core}...")
+def name_replay_sources(paths):
+    """
+    Name recordings and synthetic scenes to be served in place of cameras. A recording from .saves/<serial number>/ gets
+    the serial number of the camera it was recorded with, so it is replayed with that camera's parameters.
+    """
+    replay_list = []
+    for path in paths:
+        if is_synthetic_source(path):
+            scene = path[len(SYNTHETIC_PREFIX) + 1:]
+            sn = "synthetic-" + os.path.splitext(os.path.basename(scene))[0] if scene else "synthetic"
+            replay_list.append([path, sn])
+            continue
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        if os.path.basename(os.path.dirname(parent)) == ".saves":
+            sn = os.path.basename(parent)
+        else:
+            sn = "replay-" + os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+        replay_list.append([path, sn])
+    logging.info(f"Replay sources: {replay_list}")
+    return replay_list
+
+def camera_cores(index, camera_count, cpu_count):
+    """
+    The cores the server of a camera may run on. The cores are split between the cameras, so the capture thread, the
+    stream's stage threads, the worker threads and the detector's threads of a camera can run in parallel on its own
+    cores. With at least as many cameras as cores, every camera gets one core and they share them in turn.
+    """
+    if camera_count >= cpu_count:
+        return [index % cpu_count]
+    return list(range(index * cpu_count // camera_count, (index + 1) * cpu_count // camera_count))
+
+def start_server_with_affinity(server, cpu_cores):
+    logging.info(f"Starting server on CPU cores {cpu_cores}...")
     p = multiprocessing.Process(target=server.start_server)
     p.start()
-    psutil.Process(p.pid).cpu_affinity([cpu_core])
-    logging.info(f"Started process PID {p.pid} with affinity to core {cpu_core}")
+    psutil.Process(p.pid).cpu_affinity(cpu_cores)
+    logging.info(f"Started process PID {p.pid} with affinity to cores {cpu_cores}")
     return p
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Astrolabe coprocessor")
+    parser.add_argument("--replay", nargs="+", metavar="PATH",
+                        help="Serve video files, image directories, .saves recordings or synthetic scenes "
+                             "(synthetic or synthetic:<scene.json>) instead of the cameras")
+    parser.add_argument("--pacing", choices=REPLAY_PACINGS, default=constants.REPLAY_PACING,
+                        help="How fast recordings and synthetic scenes are played back")
+    parser.add_argument("--fps", type=float, default=constants.REPLAY_FPS, help="Frame rate for fixed pacing")
+    parser.add_argument("--no-loop", action="store_true", help="Stop at the end of a recording instead of looping")
+    args = parser.parse_args()
+    # The camera servers are forked from this process, so they pick these up when they open their recording.
+    constants.REPLAY_PACING = args.pacing
+    constants.REPLAY_FPS = args.fps
+    constants.REPLAY_LOOP = not args.no_loop
+
+    processes = []
     try:
         logging.info("Astrolabe Coprocessor startup sequence initiated.")
-        cams_list = name_valid_cams()
+        cams_list = name_replay_sources(args.replay) if args.replay else name_valid_cams()
         while cams_list == []:
             logging.warning("No cameras found, retrying in 5 seconds...")
             cams_list = name_valid_cams()
@@ -102,7 +152,6 @@ if __name__ == "__main__":
         logging.info(f"Found {len(cams_list)} camera(s): {cams_list}")
         
         servers = []
-        processes = []
 
         host_data = {}
 
@@ -111,7 +160,7 @@ if __name__ == "__main__":
             host_data[sn] = {"port": 50001 + i, "cam_index": camera_index}
             server = Server(50001 + i, CameraFunctionalObject, camera_index, sn)
             servers.append(server)
-            processes.append(start_server_with_affinity(server, i % os.cpu_count()))
+            processes.append(start_server_with_affinity(server, camera_cores(i, len(cams_list), os.cpu_count())))
 
         logging.info("Setting up Controllers server on port 49999")
         host_data["Controllers"] = {"port": 49999, "host_name": "Controllers"}
@@ -121,7 +170,7 @@ if __name__ == "__main__":
         host_data["Global"] = {"port": 50000, "host_name": "Global", "cam_index": -2}
         server = Server(50000, GlobalFunctionalObject, -2, "Global",  host_data=host_data)
         servers.append(server)
-        processes.append(start_server_with_affinity(server, 0))
+        processes.append(start_server_with_affinity(server, [0]))
 
         usb_storage_devices = []
         data_path = os.path.join(base_dir, ".saves")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The coprocessor's modules import each other by their bare names, as they do when main.py runs from Coprocessor
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
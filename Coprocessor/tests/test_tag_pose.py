@@ -0,0 +1,61 @@
+import json
+import cv2
+import numpy as np
+import pytest
+import TagPose
+from Backends import SyntheticBackend
+from constants import APRIL_TAG_WIDTH, CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS, CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS
+
+# Tags in front of the synthetic camera, as positions in meters and angles in radians in its frame
+SCENE_TAGS = [{"id": 0, "x": 0.1, "y": -0.05, "z": 1.5, "yaw": 0.3, "pitch": 0.2, "roll": 0.1},
+              {"id": 1, "x": -0.3, "y": 0.1, "z": 2.5, "yaw": -0.5, "pitch": 0.0, "roll": -0.4}]
+
+
+@pytest.fixture
+def detector():
+    from apriltag import Detector
+    try:
+        return Detector()
+    except (OSError, RuntimeError) as e:
+        pytest.skip(f"The AprilTag library is not installed: {e}")
+
+
+def test_poses_from_exact_corners():
+    fx, fy, cx, cy, tag_size = 600.0, 600.0, 320.0, 240.0, 0.2
+    rng = np.random.default_rng(0)
+    # Tags facing the camera (their z towards it, y up) at random positions, tilted by up to about 35 degrees
+    rotations = TagPose.rotation_matrices(rng.uniform(-0.6, 0.6, (50, 3))) @ np.diag([1.0, -1.0, -1.0])
+    translations = np.column_stack([rng.uniform(-0.5, 0.5, (50, 2)), rng.uniform(1, 4, 50)])
+    _, corners = TagPose.project(rotations, translations, TagPose.TAG_OBJECT_POINTS * (tag_size / 2), fx, fy, cx, cy)
+    tags = np.zeros(50, dtype=[("corners", np.float64, (4, 2)), ("homography", np.float64, (3, 3))])
+    tags["corners"] = corners
+    tags["homography"] = [cv2.getPerspectiveTransform(TagPose.TAG_OBJECT_POINTS[:, :2].astype(np.float32),
+                                                      tag_corners.astype(np.float32)) for tag_corners in corners]
+
+    found_rotations, found_translations, errors = TagPose.tag_poses(tags, fx, fy, cx, cy, tag_size)
+    np.testing.assert_allclose(found_rotations, rotations, atol=1e-6)
+    np.testing.assert_allclose(found_translations, translations, atol=1e-6)
+    assert errors.max() < 1e-6
+
+
+def test_poses_match_detection_pose(detector, tmp_path):
+    scene = tmp_path / "scene.json"
+    scene.write_text(json.dumps({"width": 640, "height": 480, "keyframes": [{"time": 0, "tags": SCENE_TAGS}]}))
+    image = cv2.cvtColor(SyntheticBackend(str(scene)).render(0), cv2.COLOR_BGR2GRAY)
+    # The renderer's camera
+    fx = 320 / np.tan(CAMERA_HORIZONTAL_FIELD_OF_VIEW_RADIANS / 2)
+    fy = 240 / np.tan(CAMERA_VERTICAL_FIELD_OF_VIEW_RADIANS / 2)
+
+    tags = detector.detect_array(image)
+    assert sorted(tags["tag_id"]) == [tag["id"] for tag in SCENE_TAGS]
+    rotations, translations, errors = TagPose.tag_poses(tags, fx, fy, 320, 240, APRIL_TAG_WIDTH)
+    for tag, rotation, translation, error in zip(tags, rotations, translations, errors):
+        pose_rotation, pose_translation, _, _ = detector.detection_pose(tag, (fx, fy, 320, 240), APRIL_TAG_WIDTH)
+        scene_tag = SCENE_TAGS[tag["tag_id"]]
+        distance = scene_tag["z"]
+        angle = np.linalg.norm(TagPose.rotation_vectors((rotation.T @ pose_rotation)[None])[0])
+
+        assert error < 1
+        assert np.linalg.norm(translation - pose_translation) < 0.01 * distance
+        assert angle < 0.02
+        assert np.linalg.norm(translation - [scene_tag[key] for key in "xyz"]) < 0.05 * distance